@@ -0,0 +1,76 @@
+"""Compare the pooled batch downloader against per-URL requests.get.
+
+Serves generated files from a local HTTP server and downloads them
+sequentially with 1 KiB chunks (the old code path) and with
+``dpm.utils.download_many``. Results are printed as JSON.
+
+    python benchmarks/bench_download.py --files 20 --size 16
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from functools import partial
+
+from common import home, serve, write_config, remove_home
+
+import requests
+from dpm import utils
+
+def baseline(target_dir, urls):
+    for url in urls:
+        response = requests.get(url, stream=True)
+        with open(os.path.join(target_dir, os.path.basename(url)), 'wb') as f:
+            for block in response.iter_content(1024):
+                f.write(block)
+
+def measure(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--size', type=int, default=16, help='file size, MiB')
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--chunk-size', type=int, default=1024, help='KiB')
+    args = parser.parse_args()
+
+    write_config(download_cache=False)
+
+    root = tempfile.mkdtemp('-dpm-bench')
+    block = os.urandom(2**20)
+    for i in range(args.files):
+        with open(os.path.join(root, 'package-%i.zip'%i), 'wb') as f:
+            for _ in range(args.size):
+                f.write(block)
+
+    server = serve(root)
+    urls = ['http://127.0.0.1:%i/package-%i.zip'%(server.server_port, i)
+        for i in range(args.files)]
+    total = args.files * args.size * 2**20
+
+    results = {}
+    try:
+        for name, func in (
+                ('baseline', baseline),
+                ('download_many', partial(utils.download_many,
+                    jobs=args.jobs, chunk_size=args.chunk_size * 1024))):
+            target_dir = tempfile.mkdtemp('-dpm-bench')
+            elapsed = measure(func, target_dir, urls)
+            shutil.rmtree(target_dir)
+            results[name] = dict(seconds=elapsed, mib_per_s=total / 2**20 / elapsed)
+    finally:
+        server.shutdown()
+        shutil.rmtree(root)
+        remove_home()
+
+    print(json.dumps(dict(files=args.files, size_mib=args.size, jobs=args.jobs,
+        results=results), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""Build, install and uninstall synthetic packages and time each phase.
+
+Generates a set of packages with a given file count, file size distribution,
+dependency depth and hook output volume, then runs the real ``dpm build``,
+``dpm install`` (served by a local HTTP server) and ``dpm uninstall``
+commands against a temporary ``~/.DICE``. ``run_process`` is timed on its own
+with a command printing many lines. Results are printed as JSON, pass
+``--compare`` with the output of an earlier run to get speedups per phase.
+
+    python benchmarks/bench_packages.py --packages 6 --depth 3 --files 500 \\
+        --size-dist lognormal --mean-size 32 -o results.json
+"""
+import os
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+
+from common import serve, write_config, revision, remove_home
+
+from dpm import utils, db
+from dpm import install, build, uninstall
+
+hook = 'import sys; sys.stdout.write("output line\\n" * %i)'
+
+def file_sizes(rng, args):
+    for _ in range(args.files):
+        if args.size_dist == 'fixed':
+            size = args.mean_size
+        elif args.size_dist == 'lognormal':
+            # median at mean_size KiB
+            size = rng.lognormvariate(0, args.sigma) * args.mean_size
+        else:
+            size = rng.expovariate(1 / args.mean_size)
+        yield max(int(size * 1024), 0)
+
+def make_package(path, name, deps, rng, pool, args):
+    lib = os.path.join(path, 'lib')
+    total = 0
+    for i, size in enumerate(file_sizes(rng, args)):
+        folder = os.path.join(lib, 'd%03i'%(i // 100))
+        os.makedirs(folder, exist_ok=True)
+        random_size = int(size * args.random)
+        start = rng.randrange(len(pool))
+        data = (pool[start:] + pool[:start])[:random_size]
+        data += b'abcdefghij' * ((size - random_size) // 10 + 1)
+        with open(os.path.join(folder, 'f%05i.bin'%i), 'wb') as f:
+            f.write(data[:size])
+        total += size
+    with open(os.path.join(path, 'package.yaml'), 'w') as f:
+        f.write('name: %s\nrelease: \'1.0\'\n'%name)
+    install_info = dict(targets=['lib'])
+    if deps:
+        install_info['dependencies'] = ['%s==1.0'%v for v in deps]
+    if args.hook_lines:
+        install_info['post_install'] = [
+            dict(args=['{python}', '-c', hook%args.hook_lines])]
+    # JSON is YAML as well
+    with open(os.path.join(path, 'install.yaml'), 'w') as f:
+        json.dump(install_info, f)
+    return total
+
+def generate(root, args):
+    # package i sits on level i % depth and depends on up to fanout packages
+    # of the next level
+    rng = random.Random(args.seed)
+    pool = bytes(rng.getrandbits(8) for _ in range(2**20))
+    names = ['bench-%i'%i for i in range(args.packages)]
+    levels = [names[i::args.depth] for i in range(args.depth)]
+    sources = {}
+    total = 0
+    for level, level_names in enumerate(levels):
+        below = levels[level + 1] if level + 1 < len(levels) else []
+        for i, name in enumerate(level_names):
+            deps = [below[(i + j) % len(below)]
+                for j in range(min(args.fanout, len(below)))]
+            path = os.path.join(root, name)
+            total += make_package(path, name, deps, rng, pool, args)
+            sources[name] = path
+    return sources, total
+
+def run(argv):
+    # the real command line entry, minus logging setup
+    args = utils.parser.parse_args(argv)
+    args.func(args)
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+def phase(latencies, size=None, files=None):
+    total = sum(latencies)
+    result = dict(
+        seconds=total,
+        latency=dict(
+            min=min(latencies),
+            median=statistics.median(latencies),
+            max=max(latencies)
+        )
+    )
+    if size is not None:
+        result['mib_per_s'] = size / 2**20 / total
+    if files is not None:
+        result['files_per_s'] = files / total
+    return result
+
+def bench_build(sources, out, args, extra=()):
+    latencies = []
+    for name, path in sources.items():
+        latencies.append(timed(run, ['build', path, '-o', out,
+            '-j', str(args.jobs)] + list(extra)))
+    return latencies
+
+def bench_install(packages, args):
+    return [timed(run, ['install'] + packages + ['-j', str(args.jobs)])]
+
+def bench_uninstall(names):
+    # dependents first, each package is removed on its own
+    latencies = []
+    for name in names:
+        latencies.append(timed(run, ['uninstall', name]))
+    return latencies
+
+def bench_run_process(lines):
+    count = [0]
+    def stdout(line):
+        count[0] += 1
+    elapsed = timed(utils.run_process, sys.executable, '-c', hook%lines,
+        stdout=stdout)
+    assert count[0] == lines, count[0]
+    return elapsed
+
+def median_phases(runs):
+    # per phase, the run with the median total time
+    result = {}
+    for key in runs[0]:
+        ordered = sorted((v[key] for v in runs), key=lambda v: v['seconds'])
+        result[key] = ordered[len(ordered) // 2]
+    return result
+
+def compare(results, path):
+    with open(path) as f:
+        old = json.load(f)['phases']
+    return {key: old[key]['seconds'] / value['seconds']
+        for key, value in results.items() if key in old}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=2, help='dependency levels')
+    parser.add_argument('--fanout', type=int, default=2, help='dependencies per package')
+    parser.add_argument('--files', type=int, default=200, help='files per package')
+    parser.add_argument('--size-dist', choices=['fixed', 'lognormal', 'exponential'], default='lognormal')
+    parser.add_argument('--mean-size', type=float, default=16, help='KiB')
+    parser.add_argument('--sigma', type=float, default=1.5, help='lognormal sigma')
+    parser.add_argument('--random', type=float, default=0.5, help='incompressible share of each file')
+    parser.add_argument('--hook-lines', type=int, default=10000, help='post_install output lines')
+    parser.add_argument('--process-lines', type=int, default=200000, help='run_process output lines')
+    parser.add_argument('--source', choices=['http', 'local'], default='http', help='install from the HTTP server or from files')
+    parser.add_argument('-j', '--jobs', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='write JSON here as well')
+    parser.add_argument('--compare', metavar='JSON', help='earlier results to compare with')
+    args = parser.parse_args()
+    args.depth = max(1, min(args.depth, args.packages))
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    write_config(download_cache=False)
+
+    root = tempfile.mkdtemp('-dpm-bench')
+    server = None
+    try:
+        sources, size = generate(os.path.join(root, 'src'), args)
+        files = args.files * args.packages
+        out = os.path.join(root, 'out')
+        if args.source == 'http':
+            server = serve(out)
+
+        runs = []
+        for _ in range(args.repeat):
+            shutil.rmtree(out, ignore_errors=True)
+            results = {}
+            results['build'] = phase(bench_build(sources, out, args), size, files)
+            results['build_incremental'] = phase(
+                bench_build(sources, out, args, ['-i']), size, files)
+            packages = sorted(glob.glob(os.path.join(out, '*.zip')))
+            if server:
+                packages = ['http://127.0.0.1:%i/%s'%(server.server_port,
+                    os.path.basename(v)) for v in packages]
+            results['install'] = phase(bench_install(packages, args), size, files)
+            assert len(db.list_packages()) == args.packages
+            results['uninstall'] = phase(bench_uninstall(list(sources)),
+                size, files)
+            assert not db.list_packages()
+            elapsed = bench_run_process(args.process_lines)
+            results['run_process'] = dict(seconds=elapsed,
+                lines_per_s=args.process_lines / elapsed)
+            runs.append(results)
+    finally:
+        if server:
+            server.shutdown()
+        shutil.rmtree(root)
+        remove_home()
+
+    report = dict(
+        revision=revision(),
+        python=platform.python_version(),
+        system=platform.platform(),
+        params={k: v for k, v in vars(args).items()
+            if k not in ('output', 'compare')},
+        size_mib=size / 2**20,
+        phases=median_phases(runs)
+    )
+    if args.compare:
+        report['speedup'] = compare(report['phases'], args.compare)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Check the startup time of dpm commands against a budget.
+
+Times fresh ``python -m dpm`` processes for ``dpm version`` and for a no-op
+``dpm install`` of an already installed package, and compares the median to
+the budget. Prints JSON and exits with status 1 when a command is over, so
+it can gate CI:
+
+    python benchmarks/bench_startup.py --budget version=150 --budget noop_install=300
+
+tests/test_startup.py runs it with the default budgets.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import shutil
+import tempfile
+
+from common import write_config, remove_home, revision
+
+# milliseconds, median of fresh processes
+default_budget = dict(version=150, noop_install=300)
+
+def dpm(*args, check=True):
+    return subprocess.run([sys.executable, '-m', 'dpm'] + list(args),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=check)
+
+def timed(args, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        dpm(*args)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+def make_package(root):
+    source = os.path.join(root, 'startup')
+    os.makedirs(os.path.join(source, 'lib'))
+    with open(os.path.join(source, 'lib', 'a.txt'), 'w') as f:
+        f.write('a\n')
+    with open(os.path.join(source, 'package.yaml'), 'w') as f:
+        f.write('name: startup\nrelease: \'1.0\'\n')
+    with open(os.path.join(source, 'install.yaml'), 'w') as f:
+        f.write('targets: [lib]\n')
+    out = os.path.join(root, 'out')
+    dpm('build', source, '-o', out)
+    return os.path.join(out, os.listdir(out)[0])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--budget', action='append', default=[],
+        metavar='COMMAND=MS', help='override a budget, may be repeated')
+    args = parser.parse_args()
+
+    budget = dict(default_budget)
+    for v in args.budget:
+        k, sep, ms = v.partition('=')
+        budget[k] = float(ms)
+
+    write_config(download_cache=False)
+    root = tempfile.mkdtemp('-dpm-bench')
+    try:
+        package = make_package(root)
+        dpm('install', package)
+        # warm up the bytecode cache
+        dpm('version')
+        commands = dict(
+            version=['version'],
+            noop_install=['install', package]
+        )
+        results = {}
+        for name, command in commands.items():
+            times = timed(command, args.repeat)
+            median = statistics.median(times)
+            results[name] = dict(median_ms=median, min_ms=min(times),
+                budget_ms=budget.get(name), ok=median <= budget.get(name, median))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        remove_home()
+
+    print(json.dumps(dict(revision=revision(), results=results), indent=2))
+    if not all(v['ok'] for v in results.values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
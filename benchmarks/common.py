@@ -0,0 +1,57 @@
+"""Shared setup of the benchmarks: a temporary ~/.DICE and a local HTTP server.
+
+Import this module before ``dpm``, the state paths are resolved on import.
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import subprocess
+import socketserver
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+home = tempfile.mkdtemp('-dpm-bench')
+os.environ['HOME'] = home
+os.environ['USERPROFILE'] = home
+sys.path.insert(0, repo)
+# child processes, e.g. the trash purge, import the same dpm
+os.environ['PYTHONPATH'] = os.pathsep.join(
+    [repo] + [v for v in os.environ.get('PYTHONPATH', '').split(os.pathsep) if v])
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Handler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def log_message(self, *args):
+        pass
+
+def serve(root):
+    handler = partial(Handler, directory=root) \
+        if sys.version_info >= (3, 7) else Handler
+    if sys.version_info < (3, 7):
+        os.chdir(root)
+    server = Server(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_config(**config):
+    config_dir = os.path.join(home, '.DICE', 'config')
+    os.makedirs(config_dir, exist_ok=True)
+    with open(os.path.join(config_dir, 'dice.json'), 'w') as f:
+        json.dump(config, f)
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def remove_home():
+    shutil.rmtree(home, ignore_errors=True)
@@ -0,0 +1,784 @@
+import os
+import zipfile
+import fnmatch
+import logging
+import zlib
+import json
+import struct
+import stat
+import time
+import hashlib
+import bz2
+import lzma
+import shutil
+import tempfile
+import mmap
+import queue
+import threading
+from copy import copy
+from collections import deque, Counter
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, Future
+from .profile import traced, count
+from .utils import load_yaml
+
+log = logging.getLogger('dpm')
+
+class ArchiveError(Exception):
+    def __str__(self):
+        return 'ArchiveError: ' + Exception.__str__(self)
+
+class SubFile:
+    # read-only view of the first `end` bytes of a file object
+
+    def __init__(self, f, end):
+        self.f = f
+        self.end = end
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        if whence == 2:
+            offset = self.end + offset
+            whence = 0
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def read(self, size=-1):
+        left = max(self.end - self.f.tell(), 0)
+        if size is None or size < 0 or size > left:
+            size = left
+        return self.f.read(size)
+
+    def close(self):
+        pass
+
+metadata_name = 'metadata.json'
+
+# stored members from this size are copied out of a mmap of the archive
+mmap_min_size = 2**24
+
+def is_targeted(arcname, targets):
+    # same selection as the glob of targets on the extracted package,
+    # a matching folder takes everything below it
+    parts = arcname.rstrip('/').split('/')
+    for v in targets:
+        pattern = v.replace(os.sep, '/').strip('/').split('/')
+        if len(pattern) > len(parts):
+            continue
+        for name, pat in zip(parts, pattern):
+            # glob leaves out hidden names unless asked for
+            if not fnmatch.fnmatch(name, pat) or \
+                    name.startswith('.') and not pat.startswith('.'):
+                break
+        else:
+            return True
+    return False
+
+def member_path(root, arcname):
+    path = os.path.normpath(os.path.join(root, *arcname.split('/')))
+    if os.path.isabs(arcname) or \
+            os.path.commonpath([root, path]) != os.path.normpath(root):
+        raise ArchiveError('Member outside of the package: %s'%arcname)
+    return path
+
+def dump_metadata(package_info, install_info):
+    # compact copy of package.yaml and install.yaml, None if yaml gave
+    # values JSON can't keep (dates, non-string keys, ...)
+    metadata = dict(package=package_info, install=install_info)
+    try:
+        data = json.dumps(metadata, sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return
+    if json.loads(data) != metadata:
+        return
+    return data.encode('utf-8')
+
+class PackageArchive:
+    # dpm package is the payload zip followed by the "addon" zip
+    # with package.yaml and install.yaml (see build); metadata.json,
+    # when present, holds both and is read instead
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        try:
+            self.addon = zipfile.ZipFile(self.f, 'r')
+            infos = self.addon.infolist()
+            if 'package.yaml' not in self.addon.NameToInfo:
+                raise ArchiveError('%s is not a dpm package'%path)
+            end = min(v.header_offset for v in infos)
+            self.payload = zipfile.ZipFile(SubFile(self.f, end), 'r') if end else None
+        except zipfile.BadZipFile as e:
+            self.f.close()
+            raise ArchiveError('%s: %s'%(path, e))
+        except:
+            self.f.close()
+            raise
+        self._package_info = None
+        self._install_info = None
+        self._metadata = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    @traced('read_yaml')
+    def read_yaml(self, name):
+        with closing(self.addon.open(name, 'r')) as f:
+            return load_yaml(f)
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = {}
+            if metadata_name in self.addon.NameToInfo:
+                self._metadata = json.loads(
+                    self.addon.read(metadata_name).decode('utf-8'))
+        return self._metadata
+
+    @property
+    def package_info(self):
+        if self._package_info is None:
+            self._package_info = self.metadata.get('package')
+            if self._package_info is None:
+                self._package_info = self.read_yaml('package.yaml')
+        return self._package_info
+
+    @property
+    def install_info(self):
+        if self._install_info is None:
+            self._install_info = self.metadata.get('install')
+            if self._install_info is None:
+                self._install_info = self.read_yaml('install.yaml')
+        return self._install_info
+
+    def zips(self):
+        if self.payload is not None:
+            yield self.payload
+        yield self.addon
+
+    def namelist(self):
+        return [name for z in self.zips() for name in z.namelist()]
+
+    def members(self, select=None):
+        # (zip, ZipInfo) of payload and addon, select takes the arcname
+        for z in self.zips():
+            for info in z.infolist():
+                if select is None or select(info.filename):
+                    yield z, info
+
+    def data_offset(self, info):
+        # member data follows the local header, its extra field may differ
+        # from the central directory one
+        self.f.seek(info.header_offset)
+        header = self.f.read(zipfile.sizeFileHeader)
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        return (info.header_offset + zipfile.sizeFileHeader +
+            fields[zipfile._FH_FILENAME_LENGTH] +
+            fields[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+    def copy_mapped(self, info, out, chunk_size=2**20):
+        # stored member copied from a mmap of the archive, the page cache
+        # backs it instead of read buffers
+        start = self.data_offset(info)
+        end = start + info.file_size
+        crc = 0
+        with mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for offset in range(start, end, chunk_size):
+                block = m[offset:min(offset + chunk_size, end)]
+                crc = zlib.crc32(block, crc)
+                out.write(block)
+        if crc != info.CRC:
+            raise ArchiveError('Bad CRC-32 for %s'%info.filename)
+
+    def extract_member(self, z, info, path, chunk_size=2**20):
+        # fixed size buffers whatever the member size, the CRC is checked
+        # while writing
+        if info.is_dir():
+            os.makedirs(path, exist_ok=True)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as out:
+            if (info.compress_type == zipfile.ZIP_STORED and
+                    not info.flag_bits & 0x1 and
+                    info.file_size >= mmap_min_size):
+                self.copy_mapped(info, out, chunk_size)
+            else:
+                with closing(z.open(info)) as f:
+                    shutil.copyfileobj(f, out, chunk_size)
+        count(files=1, bytes=info.file_size)
+
+    def extractall(self, path, select=None):
+        for z, info in self.members(select):
+            log.debug('Exctracting: %s', info.filename)
+            self.extract_member(z, info, member_path(path, info.filename))
+
+class StreamExtractor:
+    # extracts members from the package data as it arrives, by the local
+    # headers; feed() is called by the downloading thread and run() by
+    # another one, the queue bounds the data held in between. The result
+    # is only used if verify() matches it with the central directories of
+    # the complete package
+
+    local_sig = b'PK\x03\x04'
+    central_sig = b'PK\x01\x02'
+    end_sig = b'PK\x05\x06'
+    end64_sig = b'PK\x06\x06'
+    locator64_sig = b'PK\x06\x07'
+
+    def __init__(self, root, queue_size=16, chunk_size=2**20):
+        self.root = root
+        self.queue = queue.Queue(queue_size)
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.pos = 0
+        self.ended = False
+        self.members = {}
+        self.error = None
+
+    def feed(self, block):
+        self.queue.put(block)
+
+    def close(self):
+        self.queue.put(None)
+
+    def read(self, size):
+        while len(self.buffer) - self.pos < size and not self.ended:
+            block = self.queue.get()
+            if block is None:
+                self.ended = True
+            else:
+                self.buffer = self.buffer[self.pos:] + block
+                self.pos = 0
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def read_exact(self, size):
+        data = self.read(size)
+        if len(data) != size:
+            raise ArchiveError('Truncated package data')
+        return data
+
+    def skip(self, size):
+        while size:
+            size -= len(self.read_exact(min(size, self.chunk_size)))
+
+    @traced('stream_extract')
+    def run(self):
+        try:
+            self.parse()
+        except Exception as e:
+            # extracted from the file once downloaded instead
+            log.debug('Streaming extraction stopped: %s', e)
+            self.error = e
+        finally:
+            # the feeding thread must not block on a full queue
+            while not self.ended:
+                self.ended = self.queue.get() is None
+            self.buffer = b''
+
+    def parse(self):
+        while True:
+            sig = self.read(4)
+            if not sig:
+                return
+            if sig == self.local_sig:
+                self.extract_member()
+            elif sig == self.central_sig:
+                header = self.read_exact(42)
+                self.skip(sum(struct.unpack('<3H', header[24:30])))
+            elif sig == self.end_sig:
+                header = self.read_exact(18)
+                self.skip(struct.unpack('<H', header[16:18])[0])
+            elif sig == self.end64_sig:
+                self.skip(struct.unpack('<Q', self.read_exact(8))[0])
+            elif sig == self.locator64_sig:
+                self.skip(16)
+            else:
+                raise ArchiveError('Unexpected data in package')
+
+    def extract_member(self):
+        (version, flags, method, mtime, mdate, crc, compress_size, size,
+            name_size, extra_size) = struct.unpack('<5H3L2H',
+            self.read_exact(26))
+        name = self.read_exact(name_size).decode(
+            'utf-8' if flags & 0x800 else 'cp437')
+        extra = self.read_exact(extra_size)
+        if flags & 0x09:
+            # encrypted, or sizes known only after the data
+            raise ArchiveError('Can\'t stream %s'%name)
+        if 0xFFFFFFFF in (size, compress_size):
+            size, compress_size = zip64_sizes(extra, size, compress_size)
+        path = member_path(self.root, name)
+        if name.endswith('/'):
+            os.makedirs(path, exist_ok=True)
+            self.skip(compress_size)
+            self.members[name] = (crc, size)
+            return
+        if method == zipfile.ZIP_STORED:
+            decompressor = None
+        elif method == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+        elif method == zipfile.ZIP_BZIP2:
+            decompressor = bz2.BZ2Decompressor()
+        elif method == zipfile.ZIP_LZMA:
+            decompressor = zipfile.LZMADecompressor()
+        else:
+            raise ArchiveError('Unsupported compression of %s'%name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        value = written = 0
+        left = compress_size
+        with open(path, 'wb') as out:
+            while left:
+                block = self.read_exact(min(left, self.chunk_size))
+                left -= len(block)
+                if decompressor:
+                    block = decompressor.decompress(block)
+                value = zlib.crc32(block, value)
+                written += len(block)
+                out.write(block)
+            if method == zipfile.ZIP_DEFLATED:
+                block = decompressor.flush()
+                value = zlib.crc32(block, value)
+                written += len(block)
+                out.write(block)
+        if value != crc or written != size:
+            raise ArchiveError('Bad CRC-32 for %s'%name)
+        self.members[name] = (crc, size)
+        count(files=1, bytes=size)
+
+    def verify(self, archive):
+        if self.error is not None:
+            return False
+        infos = [info for z, info in archive.members()]
+        if len(set(v.filename for v in infos)) != len(self.members):
+            return False
+        return all(self.members.get(v.filename) == (v.CRC, v.file_size)
+            for v in infos)
+
+def zip64_sizes(extra, size, compress_size):
+    while len(extra) >= 4:
+        tag, length = struct.unpack('<HH', extra[:4])
+        if tag == 1:
+            values = list(struct.unpack('<%iQ'%(length // 8),
+                extra[4:4 + length // 8 * 8]))
+            if size == 0xFFFFFFFF:
+                size = values.pop(0)
+            if compress_size == 0xFFFFFFFF:
+                compress_size = values.pop(0)
+            return size, compress_size
+        extra = extra[4 + length:]
+    raise ArchiveError('Missing zip64 sizes')
+
+def get_compressor(compress_type, level=None):
+    if compress_type == zipfile.ZIP_DEFLATED:
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        return zlib.compressobj(level, zlib.DEFLATED, -15)
+    elif compress_type == zipfile.ZIP_BZIP2:
+        return bz2.BZ2Compressor(9 if level is None else level)
+    elif compress_type == zipfile.ZIP_LZMA:
+        if level is None:
+            return zipfile.LZMACompressor()
+        return LZMACompressor(level)
+
+class LZMACompressor(zipfile.LZMACompressor):
+    # the raw LZMA1 stream of zipfile.LZMACompressor with a preset
+
+    def __init__(self, preset):
+        super().__init__()
+        self.preset = preset
+
+    def _init(self):
+        props = lzma._encode_filter_properties(dict(id=lzma.FILTER_LZMA1,
+            preset=self.preset))
+        self._comp = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[
+            lzma._decode_filter_properties(lzma.FILTER_LZMA1, props)])
+        return struct.pack('<BBH', 9, 4, len(props)) + props
+
+def file_sha256(path, chunk_size=2**20):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+methods = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+    'auto': None,
+}
+
+# valid levels per method, auto deflates
+levels = {
+    'deflate': range(0, 10),
+    'bzip2': range(1, 10),
+    'lzma': range(0, 10),
+    'auto': range(0, 10),
+}
+
+# not worth compressing again
+compressed_exts = {
+    '.zip', '.whl', '.egg', '.jar', '.gz', '.tgz', '.bz2', '.xz', '.lzma',
+    '.7z', '.rar', '.zst', '.png', '.jpg', '.jpeg', '.gif', '.webp',
+    '.mp3', '.mp4', '.avi', '.mkv', '.ogg', '.pdf', '.docx', '.xlsx',
+}
+
+auto_sample_size = 2**16
+auto_min_ratio = 0.9
+
+class CompressionPolicy:
+    # first rule matching the member name wins:
+    # [{pattern: '*.png', method: stored}, {pattern: ['*.py'], method: lzma, level: 9}]
+
+    def __init__(self, rules=(), method='deflate', level=None):
+        self.rules = []
+        for rule in rules:
+            if not isinstance(rule, dict) or 'method' not in rule:
+                raise ValueError('compression rule needs a method: %r'%(rule,))
+            patterns = rule.get('pattern', '*')
+            if not isinstance(patterns, list):
+                patterns = [patterns]
+            self.rules.append((
+                [os.path.normcase(v) for v in patterns],
+                self.check(rule['method'], rule.get('level'))))
+        self.default = self.check(method, level)
+
+    @staticmethod
+    def check(method, level):
+        if method not in methods:
+            raise ValueError('unknown compression method "%s", use one of: %s'%
+                (method, ', '.join(methods)))
+        if level is not None:
+            level = int(level)
+            if method not in levels:
+                raise ValueError('%s takes no compression level'%method)
+            if level not in levels[method]:
+                raise ValueError('%s compression level must be %i-%i'%(method,
+                    levels[method][0], levels[method][-1]))
+        return method, level
+
+    @staticmethod
+    def parse(value):
+        # "method" or "method:level"
+        method, sep, level = value.partition(':')
+        return method, int(level) if sep else None
+
+    def select(self, arcname):
+        arcname = os.path.normcase(arcname)
+        for patterns, choice in self.rules:
+            for v in patterns:
+                if fnmatch.fnmatch(arcname, v):
+                    return choice
+        return self.default
+
+def auto_method(path, chunk_size=auto_sample_size):
+    if os.path.splitext(path)[1].lower() in compressed_exts:
+        return 'stored'
+    with open(path, 'rb') as f:
+        sample = f.read(chunk_size)
+    if len(zlib.compress(sample, 1)) > len(sample) * auto_min_ratio:
+        return 'stored'
+    return 'deflate'
+
+def compress_file(path, zinfo, method, level=None, chunk_size=2**20):
+    # runs in worker threads, zlib/bz2/lzma release the GIL
+    if method == 'auto':
+        method = auto_method(path)
+    zinfo.compress_type = methods[method]
+    if zinfo.compress_type == zipfile.ZIP_LZMA:
+        zinfo.flag_bits |= 0x02
+    data = tempfile.SpooledTemporaryFile(max_size=8 * 2**20)
+    compressor = get_compressor(zinfo.compress_type, level)
+    sha256 = hashlib.sha256()
+    crc = 0
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            crc = zlib.crc32(block, crc)
+            sha256.update(block)
+            size += len(block)
+            data.write(compressor.compress(block) if compressor else block)
+    if compressor:
+        data.write(compressor.flush())
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = data.tell()
+    return zinfo, data, sha256.hexdigest()
+
+class RawMember:
+    # compressed data of a member of another archive, copied as is
+
+    def __init__(self, z, info):
+        self.z = z
+        self.info = info
+
+    def copy_to(self, fp, chunk_size=2**20):
+        f = self.z.fp
+        f.seek(self.info.header_offset)
+        header = f.read(30)
+        if header[:4] != b'PK\x03\x04':
+            raise ArchiveError('Bad local header of %s'%self.info.filename)
+        name_size, extra_size = struct.unpack('<HH', header[26:30])
+        f.seek(name_size + extra_size, 1)
+        left = self.info.compress_size
+        while left:
+            block = f.read(min(left, chunk_size))
+            if not block:
+                raise ArchiveError('Truncated %s'%self.info.filename)
+            fp.write(block)
+            left -= len(block)
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def reuse(zinfo, z, info):
+        zinfo.compress_type = info.compress_type
+        zinfo.flag_bits = info.flag_bits & ~0x08
+        zinfo.CRC = info.CRC
+        zinfo.file_size = info.file_size
+        zinfo.compress_size = info.compress_size
+        return RawMember(z, info)
+
+def compress_or_reuse(path, zinfo, method, level, entry, previous):
+    sha256 = file_sha256(path)
+    if sha256 == entry['sha256']:
+        info = previous.getinfo(zinfo.filename)
+        return zinfo, RawMember.reuse(zinfo, previous, info), sha256
+    return compress_file(path, zinfo, method, level)
+
+class SharedMember:
+    # compressed data of a member written to several archives, closed once
+    # the last of its `users` has copied it
+
+    def __init__(self, data, users):
+        self.data = data
+        self.users = users
+        self.lock = threading.Lock()
+
+    def copy_to(self, fp, chunk_size=2**20):
+        offset = 0
+        while True:
+            with self.lock:
+                self.data.seek(offset)
+                block = self.data.read(chunk_size)
+            if not block:
+                break
+            fp.write(block)
+            offset += len(block)
+
+    def close(self):
+        with self.lock:
+            self.users -= 1
+            if not self.users:
+                self.data.close()
+
+class SharedCompressor:
+    # compresses each file once for the ArchiveWriters of a multi-platform
+    # build; every write has to be announced with expect() first
+
+    def __init__(self, jobs=1):
+        self.jobs = max(jobs, 1)
+        self.pool = ThreadPoolExecutor(self.jobs)
+        self.users = Counter()
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def expect(self, path, method, level):
+        self.users[(path, method, level)] += 1
+
+    def compress(self, path, zinfo, method, level, users):
+        zinfo, data, sha256 = compress_file(path, zinfo, method, level)
+        return zinfo, SharedMember(data, users), sha256
+
+    def submit(self, path, zinfo, method, level):
+        key = (path, method, level)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None:
+                future = self.futures[key] = self.pool.submit(self.compress,
+                    path, zinfo, method, level, self.users[key])
+            else:
+                count(shared=1)
+        return future
+
+    def shutdown(self):
+        self.pool.shutdown()
+        # members left by writers that failed
+        for future in self.futures.values():
+            if not future.cancelled() and future.exception() is None:
+                future.result()[1].data.close()
+
+def load_manifest(path):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(path, manifest):
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def zipinfo_from_stat(arcname, st):
+    # zipfile.ZipInfo.from_file without another stat call
+    isdir = stat.S_ISDIR(st.st_mode)
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1]).lstrip(os.sep)
+    if os.altsep:
+        arcname = arcname.lstrip(os.altsep)
+    if isdir:
+        arcname += '/'
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    if isdir:
+        zinfo.file_size = 0
+        zinfo.external_attr |= 0x10
+    else:
+        zinfo.file_size = st.st_size
+    return zinfo
+
+class ArchiveWriter:
+    # zip writer compressing members on a thread pool, members are
+    # written in the order they were added;
+    # with `previous` (payload of an earlier build) and its `manifest`
+    # unchanged members are copied without recompression; with a
+    # SharedCompressor files are compressed once for all its writers
+
+    def __init__(self, file, jobs=1, policy=None, previous=None, manifest=None,
+            compressor=None):
+        self.zip = zipfile.ZipFile(file, 'w')
+        self.jobs = max(jobs, 1)
+        self.compressor = compressor
+        self.pool = ThreadPoolExecutor(self.jobs) if compressor is None else None
+        self.policy = policy or CompressionPolicy()
+        self.previous = previous
+        self.old_manifest = manifest or {}
+        self.manifest = {}
+        self.reused = 0
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def reusable(self, zinfo, st, meta):
+        entry = self.old_manifest.get(zinfo.filename)
+        if (entry is None or self.previous is None or
+                zinfo.filename not in self.previous.NameToInfo):
+            return
+        for k in ('method', 'level', 'size'):
+            if entry.get(k) != meta[k]:
+                return
+        # the manifest has to describe this archive, not an earlier one
+        if entry.get('crc') != self.previous.getinfo(zinfo.filename).CRC:
+            return
+        return entry
+
+    def write(self, path, arcname, st=None):
+        if st is None:
+            st = os.stat(path)
+        zinfo = zipinfo_from_stat(arcname, st)
+        if zinfo.is_dir():
+            zinfo.CRC = 0
+            zinfo.compress_size = 0
+            self.add(zinfo, None)
+            return
+        count(files=1, bytes=st.st_size)
+        method, level = self.policy.select(zinfo.filename)
+        meta = dict(size=st.st_size, mtime=st.st_mtime,
+            method=method, level=level)
+        entry = self.reusable(zinfo, st, meta)
+        if entry and entry['mtime'] == st.st_mtime:
+            info = self.previous.getinfo(zinfo.filename)
+            self.add(zinfo, RawMember.reuse(zinfo, self.previous, info),
+                dict(meta, sha256=entry['sha256']))
+        elif entry:
+            future = self.pool.submit(compress_or_reuse, path, zinfo,
+                method, level, entry, self.previous)
+            self.pending.append((future, meta))
+        elif self.compressor is not None:
+            future = self.compressor.submit(path, zinfo, method, level)
+            self.pending.append((future, meta))
+        else:
+            future = self.pool.submit(compress_file, path, zinfo,
+                method, level)
+            self.pending.append((future, meta))
+        self.flush(self.jobs * 2)
+
+    def expect(self, path, arcname, st):
+        # announces a write() to the shared compressor
+        zinfo = zipinfo_from_stat(arcname, st)
+        if not zinfo.is_dir():
+            self.compressor.expect(path, *self.policy.select(zinfo.filename))
+
+    def add(self, zinfo, data, meta=None):
+        f = Future()
+        f.set_result((zinfo, data, meta and meta.get('sha256')))
+        self.pending.append((f, meta))
+        self.flush(self.jobs * 2)
+
+    def flush(self, limit):
+        while len(self.pending) > limit:
+            future, meta = self.pending.popleft()
+            zinfo, data, sha256 = future.result()
+            if isinstance(data, SharedMember):
+                # the header offset differs per archive
+                zinfo = copy(zinfo)
+            self.write_raw(zinfo, data)
+            if meta is not None:
+                self.manifest[zinfo.filename] = dict(meta, sha256=sha256,
+                    crc=zinfo.CRC)
+
+    def write_raw(self, zinfo, data):
+        z = self.zip
+        if zinfo.filename in z.NameToInfo:
+            log.warning('Duplicate name: %s', zinfo.filename)
+        zinfo.header_offset = z.fp.tell()
+        z.fp.write(zinfo.FileHeader())
+        if isinstance(data, RawMember):
+            log.debug('reused: %s', zinfo.filename)
+            self.reused += 1
+            data.copy_to(z.fp)
+        elif isinstance(data, SharedMember):
+            data.copy_to(z.fp)
+            data.close()
+        elif data is not None:
+            data.seek(0)
+            shutil.copyfileobj(data, z.fp, 2**20)
+            data.close()
+        z.filelist.append(zinfo)
+        z.NameToInfo[zinfo.filename] = zinfo
+        z.start_dir = z.fp.tell()
+        z._didModify = True
+
+    def close(self):
+        try:
+            self.flush(0)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+            self.zip.close()
+
+    def abort(self):
+        if self.pool is not None:
+            for future, meta in self.pending:
+                future.cancel()
+            self.pool.shutdown()
+        self.zip.close()
@@ -5,6 +5,7 @@ import fnmatch
 import glob
 import io
 import os
+import re
 import yaml
 from contextlib import closing
 import logging
@@ -15,10 +16,17 @@ import base64
 from struct import pack, unpack, calcsize
 from itertools import cycle
 from .install import install_package
+from .archive import ArchiveWriter, PackageArchive, CompressionPolicy, \
+    SharedCompressor, load_manifest, save_manifest, dump_metadata, \
+    metadata_name
+from .scan import IgnoreMatcher, DirCache, scan_targets
+from .profile import span
+from .delta import make_delta
 import shlex
 import rfc3987
 import tempfile
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 class BuildError(Exception):
     def __str__(self):
@@ -53,51 +61,16 @@ def build(args):
             source_dir = args.path
 
         with open(os.path.join(source_dir, 'package.yaml'), 'r') as f:
-            package_info = yaml.load(f)
+            package_info = load_yaml(f)
 
-        install_info = {}
-
-        info_files = list(args.spec)
-
-        keywords = (
-            'targets',
-            'extras',
-            'ignore',
-            'pre_build',
-            'pre_install',
-            'post_install',
-            'pre_uninstall',
-            )
-
-        sections = (
-            system_name,
-            platform_arch,
-            platform_name,
-        )
+        if args.platforms:
+            build_platforms(args, source_dir, package_info)
+            if not args.print_spec:
+                log.info('Success')
+            return
 
-        def load_install_info(path, data=None):
-            if data is None:
-                with open(path, 'r') as f:
-                    data = yaml.load(f)
-            include = data.get('include')
-            if include:
-                if not isinstance(include, list):
-                    include = [include]
-                for v in include:
-                    load_install_info(os.path.join(os.path.dirname(path), v))
-            
-            for k, v in data.items():
-                if k in keywords:
-                    if not isinstance(v, list):
-                        v = [v]
-                    install_info[k] = install_info.setdefault(k, []) + v
-            for k in sections:
-                if k in data:
-                    load_install_info(path, data[k])
-
-        for v in args.spec:
-            path = os.path.join(source_dir, v)
-            load_install_info(path)
+        install_info = load_install_info(source_dir, args.spec,
+            (system_name, platform_arch, platform_name))
 
         if args.print_spec:
             print(yaml.dump(install_info,
@@ -113,94 +86,86 @@ def build(args):
         )
 
         if not args.skip_pre_build:
-            for v in install_info.get('pre_build', ()):
-                if not run_process(command=v, cwd=source_dir, format_kwargs=variables):
-                    raise BuildError('Pre-build command error.')
+            pre_build(args, source_dir, install_info, variables)
 
         info = {}
         binaries = {}
 
-        package_name = package_info['name'].replace('/', '-')
-        platform = args.platform or platform_name
-        filename = '%s-%s-%s.zip'%(package_name, package_info['release'], platform)
+        filename = package_filename(args, package_info,
+            args.platform or platform_name)
 
-        if args.out:
-            if not os.path.exists(args.out):
-                os.makedirs(args.out)
-            filename = os.path.join(args.out, filename)
-        elif args.install:
+        if not args.out and args.install:
             target_dir = tempfile.mkdtemp('-dpm')
             temp.append(target_dir)
             filename = os.path.join(target_dir, filename)
 
-        ignore = [os.path.normpath(v) for v in install_info.pop('ignore', ())]
-        ignore.append('package.yaml')
-        for v in args.spec:
-            ignore.append(v)
-        ignore.append(filename)
+        manifest_path = filename + '.manifest'
+        previous_path = filename + '.prev'
 
-        def is_ignored(path):
-            path = os.path.relpath(path, source_dir)
-            for patt in ignore:
-                if fnmatch.fnmatch(path, patt):
-                    return True
+        is_ignored = ignore_matcher(args, source_dir, install_info,
+            (filename, manifest_path, previous_path))
 
         files = install_info.get('targets', [])
         extras = install_info.pop('extras', [])
+        policy = compression_policy(args, install_info)
+
+        previous = None
+        manifest = {}
+        if (args.incremental and os.path.exists(filename) and
+                os.path.exists(manifest_path)):
+            log.debug('Reusing unchanged members of %s', filename)
+            os.replace(filename, previous_path)
+            manifest = load_manifest(manifest_path)
+            if args.split:
+                previous = zipfile.ZipFile(previous_path)
+            else:
+                previous = PackageArchive(previous_path)
 
         log.debug('Writing %s', filename)
 
-        with closing(zipfile.ZipFile(filename, 'w')) as z:
-
-            def write_zip(path):
-                log.debug('written: %s', path)
-                arcname = os.path.relpath(path, source_dir)
-                z.write(path, arcname)
-
-            for v in files + extras:
-                for item in glob.iglob(os.path.join(source_dir, v)):
-                    if os.path.isdir(item):
-                        for root, dirnames, filenames in os.walk(item, topdown=True):
-                            if not is_ignored(os.path.relpath(root, source_dir)):
-                                write_zip(root)
-                                for fname in filenames:
-                                    fpath = os.path.join(root, fname)
-                                    if not is_ignored(os.path.relpath(fpath, source_dir)):
-                                        write_zip(fpath)
-                                    else:
-                                        log.debug('ignored: %s', fpath)
-                            else:
-                                log.debug('ignored: %s', root)
-                                dirnames[:] = []
-                    elif not is_ignored(os.path.relpath(item, source_dir)):
-                        write_zip(item)
-                    else:
-                        log.debug('ignored: %s', item)
-
-        addon = io.BytesIO()
-        with zipfile.ZipFile(addon, 'w') as z:
-            log.debug('written: %s', os.path.join(source_dir, 'package.yaml'))
-            z.write(os.path.join(source_dir, 'package.yaml'), 'package.yaml')
-            install_bytes = yaml.dump(install_info,
-                default_flow_style=False).encode('utf-8')
-            log.debug('written: %s', 'install.yaml')
-            z.writestr('install.yaml', install_bytes)
-            for k, v in binaries.items():
-                arcname = os.path.relpath(k, source_dir)
-                log.debug('saving binary: '+arcname)
-                z.writestr(arcname, v)
-
-        if args.split:
+        try:
+            with span('members'), ArchiveWriter(filename, jobs=args.jobs,
+                    policy=policy, manifest=manifest,
+                    previous=getattr(previous, 'payload', previous)) as z:
+
+                for path, arcname, entry in scan_targets(source_dir,
+                        files + extras, is_ignored):
+                    log.debug('written: %s', path)
+                    z.write(path, arcname, entry.stat() if entry else None)
+        except:
+            if previous:
+                previous.close()
+                os.replace(previous_path, filename)
+            raise
+
+        if previous:
+            previous.close()
+            os.remove(previous_path)
+        if args.incremental:
+            log.info('Reused %i of %i members', z.reused, len(z.manifest))
+            save_manifest(manifest_path, z.manifest)
+        elif os.path.exists(manifest_path):
+            # it describes the archive just replaced
+            os.remove(manifest_path)
+
+        if args.split and args.delta_from:
+            raise BuildError('--delta-from needs a single file package')
+
+        filename = write_addon(filename, args.split, source_dir, package_info,
+            install_info, binaries)
+
+        if args.delta_from:
+            with PackageArchive(args.delta_from) as old:
+                old_release = old.package_info['release']
             fname, ext = os.path.splitext(filename)
-            filename = fname + '_2.' + ext
-            with open(filename, 'wb') as z:
-                z.write(addon.getvalue())
-        else:
-            with open(filename, 'ab') as z:
-                z.write(addon.getvalue())
-        
+            delta_path = '%s-delta-%s%s'%(fname, old_release, ext)
+            log.debug('Writing %s', delta_path)
+            with span('delta'):
+                make_delta(args.delta_from, filename, delta_path)
+
         if args.install:
-            install_package(filename, force=args.force, upgrade=args.upgrade)
+            install_package(filename, force=args.force, upgrade=args.upgrade,
+                jobs=args.jobs)
 
         log.info('Success')
 
@@ -212,6 +177,250 @@ def build(args):
     finally:
         cleanup()
 
+def load_install_info(source_dir, specs, sections):
+    # merges the spec files, their includes and the given platform sections
+    install_info = {}
+
+    keywords = (
+        'targets',
+        'extras',
+        'ignore',
+        'pre_build',
+        'pre_install',
+        'post_install',
+        'pre_uninstall',
+        'dependencies',
+        'compression',
+        )
+
+    def load(path, data=None):
+        if data is None:
+            with open(path, 'r') as f:
+                data = load_yaml(f)
+        include = data.get('include')
+        if include:
+            if not isinstance(include, list):
+                include = [include]
+            for v in include:
+                load(os.path.join(os.path.dirname(path), v))
+
+        for k, v in data.items():
+            if k in keywords:
+                if not isinstance(v, list):
+                    v = [v]
+                install_info[k] = install_info.setdefault(k, []) + v
+        for k in sections:
+            if k in data:
+                load(path, data[k])
+
+    for v in specs:
+        load(os.path.join(source_dir, v))
+    return install_info
+
+def split_platform(platform):
+    # 'win64' -> ('win', '64')
+    match = re.match(r'^([a-z]+)(32|64)$', platform)
+    if not match:
+        raise BuildError('Platform %s is not <system>32 or <system>64'%platform)
+    return match.groups()
+
+def pre_build(args, source_dir, install_info, variables):
+    with span('pre_build'):
+        if not run_commands(install_info.get('pre_build', ()),
+                cwd=source_dir, format_kwargs=variables, jobs=args.jobs):
+            raise BuildError('Pre-build command error.')
+
+def package_filename(args, package_info, platform):
+    package_name = package_info['name'].replace('/', '-')
+    filename = '%s-%s-%s.zip'%(package_name, package_info['release'], platform)
+    if args.out:
+        if not os.path.exists(args.out):
+            os.makedirs(args.out)
+        filename = os.path.join(args.out, filename)
+    return filename
+
+def ignore_matcher(args, source_dir, install_info, outputs):
+    ignore = list(install_info.pop('ignore', ()))
+    ignore.append('package.yaml')
+    for v in args.spec:
+        ignore.append(v)
+    for v in outputs:
+        ignore.append(os.path.relpath(os.path.abspath(v), source_dir))
+    return IgnoreMatcher(ignore)
+
+def compression_policy(args, install_info):
+    rules = install_info.pop('compression', [])
+    try:
+        for v in reversed(args.compress):
+            pattern, sep, value = v.rpartition('=')
+            method, level = CompressionPolicy.parse(value)
+            rules.insert(0, dict(pattern=pattern or '*', method=method, level=level))
+        method, level = CompressionPolicy.parse(args.compression)
+        return CompressionPolicy(rules, method, level)
+    except ValueError as e:
+        raise BuildError('Bad compression settings: %s'%e)
+
+def write_addon(filename, split, source_dir, package_info, install_info,
+        binaries=None):
+    # returns the file the addon went to
+    if split:
+        fname, ext = os.path.splitext(filename)
+        filename = fname + '_2.' + ext
+        addon_file = open(filename, 'wb')
+    else:
+        # the addon zip goes straight after the payload
+        addon_file = open(filename, 'r+b')
+        addon_file.seek(0, os.SEEK_END)
+
+    with addon_file, span('addon'), zipfile.ZipFile(addon_file, 'w') as z:
+        log.debug('written: %s', os.path.join(source_dir, 'package.yaml'))
+        z.write(os.path.join(source_dir, 'package.yaml'), 'package.yaml')
+        install_bytes = yaml.dump(install_info,
+            default_flow_style=False).encode('utf-8')
+        log.debug('written: %s', 'install.yaml')
+        # keep the build reproducible, not stamped with the current time
+        zinfo = zipfile.ZipInfo('install.yaml',
+            z.getinfo('package.yaml').date_time)
+        zinfo.external_attr = 0o644 << 16
+        z.writestr(zinfo, install_bytes)
+        metadata = dump_metadata(package_info, install_info)
+        if metadata is not None:
+            log.debug('written: %s', metadata_name)
+            zinfo = zipfile.ZipInfo(metadata_name, zinfo.date_time)
+            zinfo.external_attr = 0o644 << 16
+            z.writestr(zinfo, metadata)
+        for k, v in (binaries or {}).items():
+            arcname = os.path.relpath(k, source_dir)
+            log.debug('saving binary: '+arcname)
+            z.writestr(arcname, v)
+    return filename
+
+def build_platforms(args, source_dir, package_info):
+    # every platform's spec is evaluated here; without pre_build steps the
+    # source tree is listed once, files common to several platforms are
+    # compressed once and the archives are written concurrently
+    if args.install or args.incremental or args.delta_from:
+        raise BuildError('--platforms can\'t be combined with --install, '
+            '--incremental or --delta-from')
+    platforms = []
+    for platform in args.platforms.split(','):
+        platform = platform.strip()
+        if platform and platform not in platforms:
+            platforms.append(platform)
+    if not platforms:
+        raise BuildError('No platforms given')
+
+    specs = []
+    for platform in platforms:
+        system, arch = split_platform(platform)
+        install_info = load_install_info(source_dir, args.spec,
+            (system, arch, platform))
+        if args.print_spec:
+            print('# %s'%platform)
+            print(yaml.dump(install_info,
+                default_flow_style=False))
+            continue
+        specs.append((platform, system, arch, install_info))
+    if args.print_spec:
+        return
+
+    outputs = [package_filename(args, package_info, v) for v in platforms]
+    def prepare(platform, install_info):
+        is_ignored = ignore_matcher(args, source_dir, install_info, outputs)
+        patterns = install_info.get('targets', []) + \
+            install_info.pop('extras', [])
+        return (package_filename(args, package_info, platform), install_info,
+            is_ignored, patterns, compression_policy(args, install_info))
+
+    if not args.skip_pre_build and any(v[3].get('pre_build') for v in specs):
+        build_sequential(args, source_dir, package_info, specs, prepare)
+        return
+    builds = [prepare(v[0], v[3]) for v in specs]
+
+    # all members are listed before writing starts, so the compressor knows
+    # how many archives take each file
+    compressor = SharedCompressor(args.jobs)
+    listdir = DirCache()
+    writers = []
+    try:
+        with span('scan'):
+            for filename, install_info, is_ignored, patterns, policy in builds:
+                z = ArchiveWriter(filename, jobs=args.jobs, policy=policy,
+                    compressor=compressor)
+                members = []
+                writers.append((filename, install_info, z, members))
+                for path, arcname, entry in scan_targets(source_dir, patterns,
+                        is_ignored, listdir):
+                    st = entry.stat() if entry else os.stat(path)
+                    z.expect(path, arcname, st)
+                    members.append((path, arcname, st))
+
+        def write(filename, install_info, z, members):
+            log.debug('Writing %s', filename)
+            with span('members'), z:
+                for path, arcname, st in members:
+                    log.debug('written: %s', path)
+                    z.write(path, arcname, st)
+            write_addon(filename, args.split, source_dir, package_info,
+                install_info)
+
+        with ThreadPoolExecutor(len(writers)) as pool:
+            futures = [pool.submit(write, *v) for v in writers]
+            for future in futures:
+                future.result()
+    except:
+        # writers that never started
+        for filename, install_info, z, members in writers:
+            if z.zip.fp is not None:
+                z.abort()
+        raise
+    finally:
+        compressor.shutdown()
+
+def build_sequential(args, source_dir, package_info, specs, prepare):
+    # pre_build may change the sources, so each platform is built before
+    # the next one's pre_build runs; members are copied from the archive of
+    # the previous platform when their sha256 matches
+    previous = None
+    manifest = {}
+    reused = 0
+    try:
+        for platform, system, arch, install_info in specs:
+            variables = dict(
+                path=source_dir,
+                python=sys.executable,
+                platform=platform,
+                arch=arch,
+                system=system
+            )
+            pre_build(args, source_dir, install_info, variables)
+            filename, install_info, is_ignored, patterns, policy = prepare(
+                platform, install_info)
+            log.debug('Writing %s', filename)
+            with span('members'), ArchiveWriter(filename, jobs=args.jobs,
+                    policy=policy, manifest=manifest,
+                    previous=getattr(previous, 'payload', previous)) as z:
+                for path, arcname, entry in scan_targets(source_dir, patterns,
+                        is_ignored):
+                    log.debug('written: %s', path)
+                    z.write(path, arcname, entry.stat() if entry else None)
+            write_addon(filename, args.split, source_dir, package_info,
+                install_info)
+            if previous:
+                previous.close()
+                previous = None
+            if args.split:
+                previous = zipfile.ZipFile(filename)
+            else:
+                previous = PackageArchive(filename)
+            # no mtime, so every member is compared by its sha256
+            manifest = {k: dict(v, mtime=None) for k, v in z.manifest.items()}
+            reused += z.reused
+        log.info('Reused %i members of earlier platforms', reused)
+    finally:
+        if previous:
+            previous.close()
+
 def cleanup():
     log.info('Cleanup')
     for folder in temp:
@@ -225,11 +434,19 @@ parser.add_argument('path', help="specify directory of package sources")
 parser.add_argument('-v', '--verbose', action='store_true', help="detailed output")
 parser.add_argument('-o', '--out', help='Output folder')
 parser.add_argument('-s', '--spec', nargs = '*', default=['install.yaml'], help='The "yaml" files with package specification')
-parser.add_argument('--platform', help="Platform for new package")
+platform_group = parser.add_mutually_exclusive_group()
+platform_group.add_argument('--platform', help="Platform for new package")
+platform_group.add_argument('--platforms', metavar='PLATFORM,...', help="build a package for each platform, e.g. win64,linux64, with its spec sections")
 parser.add_argument('--print-spec', action='store_true', help="Prints specs merge result and exit")
 parser.add_argument('--skip-pre-build', action='store_true', help="Skip running pre-build commands")
 parser.add_argument('-u', '--upgrade', action='store_true', help="upgrade installation")
 parser.add_argument('-f', '--force', action='store_true', help="force install")
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="number of parallel jobs")
+
+parser.add_argument('--compression', default='deflate', metavar='METHOD[:LEVEL]', help="default compression: stored, deflate, bzip2, lzma or auto (default: deflate)")
+parser.add_argument('--compress', action='append', default=[], metavar='PATTERN=METHOD[:LEVEL]', help="compression for members matching the pattern, may be repeated")
+parser.add_argument('-i', '--incremental', action='store_true', help="reuse unchanged members of the previous build in the output folder")
+parser.add_argument('--delta-from', metavar='PACKAGE', help="also write a delta package updating the given previous release")
 
 excl_group = parser.add_mutually_exclusive_group()
 excl_group.add_argument('--split', action='store_true', help="Split package in two zip files")
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+log = logging.getLogger('dpm')
+
+def lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+def unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class DownloadCache:
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.index_path = os.path.join(root, 'index.json')
+        self.lock = threading.Lock()
+        self.pinned = set()
+        self.index = None
+
+    def load(self):
+        self.index = {'urls': {}, 'objects': {}}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.index = json.load(f)
+            except ValueError:
+                log.warning('Download cache index is corrupted, resetting')
+        return self.index
+
+    @contextmanager
+    def locked(self):
+        # the index is read again under a file lock, other dpm processes
+        # sharing the cache may have changed it
+        with self.lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self.index_path + '.lock', 'a+b') as f:
+                lock_file(f)
+                try:
+                    yield self.load()
+                finally:
+                    unlock_file(f)
+
+    def save(self):
+        tmp = self.index_path + '.%i.tmp'%os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+
+    def object_path(self, sha256, fname):
+        return os.path.join(self.root, 'objects', sha256, fname)
+
+    def partial_path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, 'partial', key)
+
+    def lookup(self, url):
+        with self.locked() as index:
+            entry = index['urls'].get(url)
+            if not entry:
+                return
+            obj = index['objects'].get(entry['sha256'])
+            if obj:
+                path = self.object_path(entry['sha256'], obj['fname'])
+                if os.path.exists(path):
+                    obj['atime'] = time.time()
+                    self.pinned.add(entry['sha256'])
+                    self.save()
+                    return dict(entry, path=path)
+            del index['urls'][url]
+            self.save()
+
+    @contextmanager
+    def claim(self, url):
+        # one transfer of url at a time, across threads and processes; the
+        # partial file is only written while this is held
+        path = self.partial_path(url) + '.lock'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a+b') as f:
+            lock_file(f)
+            try:
+                yield
+            finally:
+                unlock_file(f)
+
+    def partial(self, url):
+        path = self.partial_path(url)
+        validators = {}
+        size = 0
+        if os.path.exists(path) and os.path.exists(path + '.json'):
+            with open(path + '.json', 'r') as f:
+                validators = json.load(f)
+            size = os.path.getsize(path)
+        return path, size, validators
+
+    def begin(self, url, validators):
+        path = self.partial_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.json', 'w') as f:
+            json.dump(validators, f)
+        return path
+
+    def commit(self, url, partial, fname, sha256, validators):
+        with self.locked() as index:
+            path = self.object_path(sha256, fname)
+            obj = index['objects'].get(sha256)
+            if obj and os.path.exists(self.object_path(sha256, obj['fname'])):
+                path = self.object_path(sha256, obj['fname'])
+                os.remove(partial)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(partial, path)
+                obj = index['objects'][sha256] = dict(fname=fname,
+                    size=os.path.getsize(path))
+            obj['atime'] = time.time()
+            if os.path.exists(partial + '.json'):
+                os.remove(partial + '.json')
+            index['urls'][url] = dict(validators, sha256=sha256)
+            self.pinned.add(sha256)
+            self.evict()
+            self.save()
+            return path
+
+    def evict(self):
+        index = self.index
+        objects = index['objects']
+        total = sum(v['size'] for v in objects.values())
+        for sha256 in sorted(objects, key=lambda k: objects[k]['atime']):
+            if total <= self.max_size:
+                break
+            if sha256 in self.pinned:
+                continue
+            log.debug('Evicting %s from download cache', objects[sha256]['fname'])
+            shutil.rmtree(os.path.join(self.root, 'objects', sha256),
+                ignore_errors=True)
+            total -= objects.pop(sha256)['size']
+        for url, entry in list(index['urls'].items()):
+            if entry['sha256'] not in objects:
+                del index['urls'][url]
+        # objects the index lost, objects are only added under the lock
+        objects_dir = os.path.join(self.root, 'objects')
+        if os.path.isdir(objects_dir):
+            for sha256 in os.listdir(objects_dir):
+                if sha256 not in objects:
+                    log.debug('Removing unindexed %s from download cache', sha256)
+                    shutil.rmtree(os.path.join(objects_dir, sha256),
+                        ignore_errors=True)
@@ -0,0 +1,92 @@
+import os
+import json
+import logging
+import threading
+
+log = logging.getLogger('dpm')
+
+packages_install_dir  = os.path.join(os.path.expanduser("~"), ".DICE", "data", "packages")
+dice_config = os.path.join(os.path.expanduser("~"), ".DICE", "config", "dice.json")
+
+class Config:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.stamp = None
+        self.data = {}
+        self.locations = None
+
+    def get_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        return st.st_mtime, st.st_size
+
+    def load(self):
+        with self.lock:
+            stamp = self.get_stamp()
+            if stamp != self.stamp:
+                data = {}
+                if stamp is not None:
+                    log.debug('Loading %s', self.path)
+                    with open(self.path) as f:
+                        data = json.load(f)
+                self.data = data
+                self.stamp = stamp
+                self.locations = None
+            return self.data
+
+    def packages_dirs(self):
+        cfg = self.load()
+        paths = list(cfg.get('packages_dirs', []))
+        paths.append(cfg.get('packages_install_dir', packages_install_dir))
+        return paths
+
+    def index(self):
+        # package folder name -> folder, first packages dir wins
+        with self.lock:
+            paths = self.packages_dirs()
+            if self.locations is None:
+                locations = {}
+                for path in reversed(paths):
+                    if not os.path.isdir(path):
+                        continue
+                    for entry in os.scandir(path):
+                        if not entry.name.startswith('.') and entry.is_dir():
+                            locations[entry.name] = entry.path
+                self.locations = locations
+            return self.locations
+
+    def install_path(self, package_name):
+        package_name = package_name.replace('/', '-')
+        with self.lock:
+            path = self.index().get(package_name)
+            if path is None:
+                path = os.path.join(self.packages_dirs()[-1], package_name)
+            return path
+
+    def update_location(self, package_name, path=None):
+        package_name = package_name.replace('/', '-')
+        with self.lock:
+            if self.locations is None:
+                return
+            if path is None:
+                self.locations.pop(package_name, None)
+            else:
+                self.locations[package_name] = path
+
+config = Config(dice_config)
+
+def get_config():
+    return config.load()
+
+def get_packages_dirs():
+    return config.packages_dirs()
+
+def get_install_path(package_name):
+    return config.install_path(package_name)
+
+def update_location(package_name, path=None):
+    config.update_location(package_name, path)
@@ -0,0 +1,298 @@
+import os
+import json
+import sqlite3
+import threading
+from .utils import log, get_packages_dirs, info_from_name, load_yaml
+
+db_path = os.path.join(os.path.expanduser("~"), ".DICE", "data", "dpm.db")
+
+schema = '''
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT PRIMARY KEY,
+    release TEXT NOT NULL,
+    install_path TEXT NOT NULL,
+    package_info TEXT NOT NULL,
+    install_info TEXT NOT NULL,
+    auto INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS files (
+    package TEXT NOT NULL,
+    path TEXT NOT NULL,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS files_package ON files (package);
+CREATE TABLE IF NOT EXISTS deps (
+    package TEXT NOT NULL,
+    dependency TEXT NOT NULL,
+    PRIMARY KEY (package, dependency)
+);
+CREATE INDEX IF NOT EXISTS deps_dependency ON deps (dependency);
+CREATE TABLE IF NOT EXISTS previous (
+    name TEXT PRIMARY KEY,
+    release TEXT NOT NULL,
+    install_path TEXT NOT NULL,
+    package_info TEXT NOT NULL,
+    install_info TEXT NOT NULL,
+    files TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+local = threading.local()
+migrate_lock = threading.Lock()
+
+def connect():
+    conn = getattr(local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=60)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(schema)
+        with migrate_lock:
+            upgrade(conn)
+            migrate(conn)
+        local.conn = conn
+    return conn
+
+def upgrade(conn):
+    columns = [v['name'] for v in conn.execute('PRAGMA table_info(files)')]
+    if 'hash' not in columns:
+        conn.execute('ALTER TABLE files ADD COLUMN hash TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_hash ON files (hash)')
+    columns = [v['name'] for v in conn.execute('PRAGMA table_info(packages)')]
+    if 'auto' not in columns:
+        # packages installed so far count as explicitly installed
+        conn.execute('ALTER TABLE packages ADD COLUMN auto INTEGER NOT NULL '
+            'DEFAULT 0')
+    conn.commit()
+
+def migrate(conn):
+    # one-time import of the package.yaml/install.yaml/files.txt layout
+    row = conn.execute("SELECT value FROM meta WHERE key='migrated'").fetchone()
+    if row:
+        return
+    with conn:
+        for packages_dir in get_packages_dirs():
+            if not os.path.isdir(packages_dir):
+                continue
+            for entry in os.scandir(packages_dir):
+                # dpm's own folders, e.g. packages still being extracted
+                if entry.name.startswith('.'):
+                    continue
+                package_yaml = os.path.join(entry.path, 'package.yaml')
+                if not entry.is_dir() or not os.path.exists(package_yaml):
+                    continue
+                with open(package_yaml, 'r') as f:
+                    package_info = load_yaml(f)
+                install_info = {}
+                install_yaml = os.path.join(entry.path, 'install.yaml')
+                if os.path.exists(install_yaml):
+                    with open(install_yaml, 'r') as f:
+                        install_info = load_yaml(f) or {}
+                files = []
+                files_txt = os.path.join(entry.path, 'files.txt')
+                if os.path.exists(files_txt):
+                    with open(files_txt, 'r') as f:
+                        files = [v for v in f.read().split('\n') if v]
+                if conn.execute('SELECT 1 FROM packages WHERE name=?',
+                        (package_info['name'],)).fetchone():
+                    continue
+                log.debug('Migrating %s', entry.path)
+                _add_package(conn, package_info, install_info, entry.path, files)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('migrated', '1')")
+
+def _cache(conn):
+    # parsed rows of this thread, until another connection changes the database
+    version = conn.execute('PRAGMA data_version').fetchone()[0]
+    cache = getattr(local, 'cache', None)
+    if cache is None or local.version != version:
+        cache = local.cache = {}
+        local.version = version
+    return cache
+
+def _invalidate():
+    # data_version doesn't change for writes on the own connection
+    local.cache = None
+
+def _dumps(data):
+    return json.dumps(data, default=str)
+
+def _add_package(conn, package_info, install_info, install_path, files,
+        hashes=None, auto=None):
+    # hashes: path -> package store key;
+    # auto: installed only as a dependency, an explicitly installed package
+    # stays explicit and None keeps the current state
+    name = package_info['name']
+    hashes = hashes or {}
+    deps = set(info_from_name(v)[0]
+        for v in install_info.get('dependencies') or ())
+    row = conn.execute('SELECT auto FROM packages WHERE name=?',
+        (name,)).fetchone()
+    if row is not None and auto is not False:
+        auto = row['auto']
+    _remove_package(conn, name)
+    conn.execute('INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?)',
+        (name, str(package_info['release']), install_path,
+        _dumps(package_info), _dumps(install_info), int(bool(auto))))
+    conn.executemany('INSERT INTO files VALUES (?, ?, ?)',
+        ((name, v, hashes.get(v)) for v in files))
+    conn.executemany('INSERT INTO deps VALUES (?, ?)',
+        ((name, v) for v in deps))
+
+def _remove_package(conn, name):
+    conn.execute('DELETE FROM packages WHERE name=?', (name,))
+    conn.execute('DELETE FROM files WHERE package=?', (name,))
+    conn.execute('DELETE FROM deps WHERE package=?', (name,))
+
+def add_package(package_info, install_info, install_path, files,
+        hashes=None, auto=False):
+    conn = connect()
+    _invalidate()
+    with conn:
+        _add_package(conn, package_info, install_info, install_path, files,
+            hashes, auto)
+
+def remove_package(name):
+    conn = connect()
+    _invalidate()
+    with conn:
+        _remove_package(conn, name)
+        conn.execute('DELETE FROM previous WHERE name=?', (name,))
+
+def _get_record(conn, table, name):
+    row = conn.execute('SELECT * FROM %s WHERE name=?'%table,
+        (name,)).fetchone()
+    if row is None:
+        return
+    if table == 'packages':
+        files = [v[0] for v in conn.execute(
+            'SELECT path FROM files WHERE package=? ORDER BY rowid', (name,))]
+    else:
+        files = json.loads(row['files'])
+    return (json.loads(row['package_info']), json.loads(row['install_info']),
+        row['install_path'], files)
+
+def _set_previous(conn, name, record):
+    if record is None:
+        conn.execute('DELETE FROM previous WHERE name=?', (name,))
+        return
+    package_info, install_info, install_path, files = record
+    conn.execute('INSERT OR REPLACE INTO previous VALUES (?, ?, ?, ?, ?, ?)',
+        (name, str(package_info['release']), install_path,
+        _dumps(package_info), _dumps(install_info), _dumps(files)))
+
+def replace_package(package_info, install_info, install_path, files,
+        hashes=None, auto=False):
+    # the installed release becomes the previous one, store keys of its files
+    # are not kept, the previous folder holds its own links
+    conn = connect()
+    _invalidate()
+    with conn:
+        name = package_info['name']
+        _set_previous(conn, name, _get_record(conn, 'packages', name))
+        _add_package(conn, package_info, install_info, install_path, files,
+            hashes, auto)
+
+def patch_package(package_info, install_info, install_path, files,
+        hashes=None, auto=False):
+    # release updated in place by a delta, the previous one is gone
+    conn = connect()
+    _invalidate()
+    with conn:
+        _add_package(conn, package_info, install_info, install_path, files,
+            hashes, auto)
+        conn.execute('DELETE FROM previous WHERE name=?',
+            (package_info['name'],))
+
+def rollback_package(name):
+    # swaps the installed and the previous release
+    conn = connect()
+    _invalidate()
+    with conn:
+        current = _get_record(conn, 'packages', name)
+        previous = _get_record(conn, 'previous', name)
+        if previous is None:
+            return False
+        _add_package(conn, *previous)
+        _set_previous(conn, name, current)
+    return True
+
+def get_previous(name):
+    row = connect().execute('SELECT * FROM previous WHERE name=?',
+        (name,)).fetchone()
+    if row:
+        return dict(
+            name=row['name'],
+            release=row['release'],
+            install_path=row['install_path'],
+            package_info=json.loads(row['package_info']),
+            install_info=json.loads(row['install_info']),
+            files=json.loads(row['files'])
+        )
+
+def get_package(name):
+    # memoized, the result must not be modified
+    conn = connect()
+    cache = _cache(conn)
+    if name not in cache:
+        row = conn.execute('SELECT * FROM packages WHERE name=?',
+            (name,)).fetchone()
+        cache[name] = None
+        if row:
+            cache[name] = dict(
+                name=row['name'],
+                release=row['release'],
+                install_path=row['install_path'],
+                package_info=json.loads(row['package_info']),
+                install_info=json.loads(row['install_info']),
+                auto=bool(row['auto'])
+            )
+    return cache[name]
+
+def list_packages():
+    return [v[0] for v in connect().execute(
+        'SELECT name FROM packages ORDER BY name')]
+
+def set_auto(name, auto):
+    conn = connect()
+    _invalidate()
+    with conn:
+        conn.execute('UPDATE packages SET auto=? WHERE name=?',
+            (int(bool(auto)), name))
+
+def get_graph():
+    # {name: auto} of installed packages and (package, dependency) pairs
+    conn = connect()
+    packages = dict((v['name'], bool(v['auto'])) for v in
+        conn.execute('SELECT name, auto FROM packages'))
+    return packages, conn.execute(
+        'SELECT package, dependency FROM deps').fetchall()
+
+def get_files(name):
+    return [v[0] for v in connect().execute(
+        'SELECT path FROM files WHERE package=? ORDER BY rowid', (name,))]
+
+def get_hashes(name):
+    return [v[0] for v in connect().execute(
+        'SELECT DISTINCT hash FROM files WHERE package=? AND hash IS NOT NULL',
+        (name,))]
+
+def get_file_hashes(name):
+    return dict(connect().execute(
+        'SELECT path, hash FROM files WHERE package=? AND hash IS NOT NULL',
+        (name,)).fetchall())
+
+def unreferenced(hashes):
+    conn = connect()
+    result = []
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        used = set(v[0] for v in conn.execute(
+            'SELECT DISTINCT hash FROM files WHERE hash IN (%s)'%
+            ','.join('?'*len(chunk)), chunk))
+        result += [v for v in chunk if v not in used]
+    return result
@@ -0,0 +1,399 @@
+import os
+import json
+import mmap
+import stat
+import struct
+import shutil
+import hashlib
+import logging
+import zipfile
+import tempfile
+from contextlib import closing, contextmanager
+from .archive import (ArchiveError, PackageArchive, file_sha256, is_targeted,
+    member_path, mmap_min_size)
+
+log = logging.getLogger('dpm')
+
+# delta package: a dpm package whose payload holds "files/<arcname>" for
+# new or replaced files and "diffs/<arcname>" for patched ones, and whose
+# addon holds delta.json next to the metadata of the new release
+delta_name = 'delta.json'
+delta_version = 1
+
+block_size = 4096
+# bytes of a block looked up at every offset
+key_size = 32
+# ship the whole file when the diff saves less than this
+max_diff_ratio = 0.8
+
+diff_magic = b'DPMDIFF1'
+
+class DeltaError(Exception):
+    def __str__(self):
+        return 'DeltaError: ' + Exception.__str__(self)
+
+def common_prefix(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def common_suffix(a, b, limit):
+    lo, hi = 0, min(len(a), len(b)) - limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def diff(old, new, out, max_literal=None):
+    # writes copy/literal instructions rebuilding new from old: common prefix
+    # and suffix, then runs of new starting with a block of old, searched at
+    # every offset so inserted bytes don't break the matching. old and new
+    # may be mmaps, literals are written straight from them. Returns False,
+    # with out incomplete, once more than max_literal bytes can't be copied
+    copying = None
+    literal_size = 0
+    def flush():
+        nonlocal copying
+        if copying:
+            out.write(b'C' + struct.pack('<QQ', *copying))
+            copying = None
+    def copy(offset, length):
+        nonlocal copying
+        if copying and sum(copying) == offset:
+            copying = (copying[0], copying[1] + length)
+            return
+        flush()
+        if length:
+            copying = (offset, length)
+    def literal(data):
+        nonlocal literal_size
+        literal_size += len(data)
+        if len(data):
+            flush()
+            out.write(b'L' + struct.pack('<Q', len(data)))
+            out.write(data)
+
+    out.write(diff_magic + struct.pack('<Q', len(new)))
+    with memoryview(old) as old_view, memoryview(new) as new_view:
+        prefix = common_prefix(old_view, new_view)
+        suffix = common_suffix(old_view, new_view, prefix)
+        copy(0, prefix)
+
+        index = {}
+        for offset in range(prefix, len(old) - suffix - block_size + 1,
+                block_size):
+            index.setdefault(old[offset:offset + key_size], offset)
+
+        start = i = prefix
+        end = len(new) - suffix
+        if max_literal is not None:
+            if end - prefix > max_literal and \
+                    not sample_matches(old_view, new_view, index, prefix, end):
+                return False
+        while i + block_size <= end:
+            offset = index.get(new[i:i + key_size])
+            if offset is None or old_view[offset:offset + block_size] != \
+                    new_view[i:i + block_size]:
+                i += 1
+                if max_literal is not None and \
+                        literal_size + i - start > max_literal:
+                    return False
+                continue
+            length = block_size + common_prefix(
+                old_view[offset + block_size:], new_view[i + block_size:end])
+            literal(new_view[start:i])
+            copy(offset, length)
+            i += length
+            start = i
+        literal(new_view[start:end])
+        if max_literal is not None and literal_size > max_literal:
+            return False
+        copy(len(old) - suffix, suffix)
+        flush()
+    return True
+
+def sample_matches(old_view, new_view, index, start, end, samples=16):
+    # whether any of a few windows of new holds a block of old; the offsets
+    # of a window are all tried, like diff does
+    step = max((end - start) // samples, block_size)
+    for i in range(start, end - block_size + 1, step):
+        for j in range(i, min(i + block_size, end - block_size + 1)):
+            offset = index.get(bytes(new_view[j:j + key_size]))
+            if offset is not None and old_view[offset:offset + block_size] \
+                    == new_view[j:j + block_size]:
+                return True
+    return False
+
+def patch(old_path, diff_f, out_f, chunk_size=2**20):
+    if diff_f.read(len(diff_magic)) != diff_magic:
+        raise DeltaError('Bad diff data')
+    size = struct.unpack('<Q', diff_f.read(8))[0]
+    written = 0
+    with open(old_path, 'rb') as old:
+        while True:
+            op = diff_f.read(1)
+            if not op:
+                break
+            if op == b'C':
+                offset, length = struct.unpack('<QQ', diff_f.read(16))
+                old.seek(offset)
+                source = old
+            elif op == b'L':
+                length = struct.unpack('<Q', diff_f.read(8))[0]
+                source = diff_f
+            else:
+                raise DeltaError('Bad diff data')
+            while length:
+                data = source.read(min(length, chunk_size))
+                if not data:
+                    raise DeltaError('Truncated diff data')
+                out_f.write(data)
+                length -= len(data)
+                written += len(data)
+    if written != size:
+        raise DeltaError('Bad diff data')
+
+def targeted_members(archive, targets):
+    # arcname -> ZipInfo of files that install into the package folder
+    result = {}
+    if archive.payload is None:
+        return result
+    for info in archive.payload.infolist():
+        if not info.is_dir() and is_targeted(info.filename, targets):
+            result[info.filename] = info
+    return result
+
+@contextmanager
+def member_data(z, info):
+    # bytes, or for large members a mmap of a temporary copy
+    if info.file_size < mmap_min_size:
+        with closing(z.open(info)) as f:
+            yield f.read()
+        return
+    with tempfile.TemporaryFile() as tmp:
+        with closing(z.open(info)) as f:
+            shutil.copyfileobj(f, tmp, 2**20)
+        tmp.flush()
+        with mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            yield m
+
+def write_member(z, zinfo, data, size, chunk_size=2**20):
+    # data: bytes, mmap or file object
+    with z.open(zinfo, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as f:
+        if hasattr(data, 'read'):
+            shutil.copyfileobj(data, f, chunk_size)
+            return
+        with memoryview(data) as view:
+            for offset in range(0, len(view), chunk_size):
+                f.write(view[offset:offset + chunk_size])
+
+def file_mode(info):
+    return stat.S_IMODE(info.external_attr >> 16)
+
+def add_member(payload, arcname, info, data, sha256, old_payload, old_info,
+        patched):
+    # writes a diff against the old member if it pays, returns True when
+    # the whole file had to be written
+    if old_info is not None:
+        with member_data(old_payload, old_info) as old_data:
+            base = hashlib.sha256(old_data).hexdigest()
+            if base == sha256 and file_mode(old_info) == file_mode(info):
+                return False
+            with tempfile.TemporaryFile() as tmp:
+                # a mode change alone is patched as well
+                if diff(old_data, data, tmp, len(data) * max_diff_ratio) and \
+                        (base == sha256 or
+                        tmp.tell() < len(data) * max_diff_ratio):
+                    log.debug('patched: %s', arcname)
+                    patched[arcname] = dict(base=base)
+                    size = tmp.tell()
+                    tmp.seek(0)
+                    zinfo = zipfile.ZipInfo('diffs/' + arcname, info.date_time)
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    write_member(payload, zinfo, tmp, size)
+                    return False
+    log.debug('added: %s', arcname)
+    zinfo = zipfile.ZipInfo('files/' + arcname, info.date_time)
+    zinfo.external_attr = info.external_attr
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    write_member(payload, zinfo, data, len(data))
+    return True
+
+def make_delta(old_path, new_path, delta_path):
+    # False, and no file written, when the releases can't be bridged
+    try:
+        return _make_delta(old_path, new_path, delta_path)
+    except:
+        if os.path.exists(delta_path):
+            os.remove(delta_path)
+        raise
+
+def _make_delta(old_path, new_path, delta_path):
+    with PackageArchive(old_path) as old, PackageArchive(new_path) as new:
+        targets = new.install_info.get('targets', [])
+        if old.install_info.get('targets', []) != targets:
+            log.warning('Targets changed since %s, no delta',
+                old.package_info['release'])
+            return False
+        old_members = targeted_members(old, targets)
+        new_members = targeted_members(new, targets)
+
+        files = {}
+        added = []
+        patched = {}
+        payload = zipfile.ZipFile(delta_path, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            for arcname, info in sorted(new_members.items()):
+                with member_data(new.payload, info) as data:
+                    sha256 = hashlib.sha256(data).hexdigest()
+                    files[arcname] = dict(sha256=sha256, size=len(data),
+                        mode=file_mode(info))
+                    if add_member(payload, arcname, info, data, sha256,
+                            old.payload, old_members.get(arcname), patched):
+                        added.append(arcname)
+        finally:
+            payload.close()
+
+        removed = sorted(set(old_members) - set(new_members))
+        info = dict(
+            version=delta_version,
+            base=dict(name=old.package_info['name'],
+                release=old.package_info['release']),
+            full=dict(name=os.path.basename(new_path),
+                sha256=file_sha256(new_path)),
+            files=files,
+            added=added,
+            patched=patched,
+            removed=removed
+        )
+
+        # the addon zip goes straight after the payload
+        with open(delta_path, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            with zipfile.ZipFile(f, 'w') as z:
+                for name in new.addon.namelist():
+                    z.writestr(new.addon.getinfo(name), new.addon.read(name))
+                zinfo = zipfile.ZipInfo(delta_name,
+                    new.addon.getinfo('package.yaml').date_time)
+                zinfo.external_attr = 0o644 << 16
+                z.writestr(zinfo, json.dumps(info, sort_keys=True).encode('utf-8'),
+                    zipfile.ZIP_DEFLATED)
+    log.info('Delta from %s: %i added, %i patched, %i removed',
+        info['base']['release'], len(added), len(patched), len(removed))
+    return True
+
+def read_delta(archive):
+    if delta_name not in archive.addon.NameToInfo:
+        return
+    return json.loads(archive.addon.read(delta_name).decode('utf-8'))
+
+def delta_path(install_path, arcname):
+    try:
+        return member_path(install_path, arcname)
+    except ArchiveError as e:
+        raise DeltaError(*e.args)
+
+def check_delta(delta, archive, installed):
+    # raises DeltaError when the installed release isn't the delta's base
+    install_info = archive.install_info
+    if installed['package_info']['release'] != delta['base']['release']:
+        raise DeltaError('Installed release is %s, delta is from %s'%(
+            installed['package_info']['release'], delta['base']['release']))
+    if installed['install_info'].get('targets', []) != \
+            install_info.get('targets', []):
+        raise DeltaError('Targets changed')
+    if install_info.get('pre_install') or install_info.get('post_install'):
+        # install hooks need the complete package
+        raise DeltaError('Package has install hooks')
+    install_path = installed['install_path']
+    for arcname in set(delta['files']).union(delta['added'],
+            delta['patched'], delta['removed']):
+        delta_path(install_path, arcname)
+    for arcname, v in delta['patched'].items():
+        path = delta_path(install_path, arcname)
+        if not os.path.isfile(path) or file_sha256(path) != v['base']:
+            raise DeltaError('%s was modified'%path)
+    # files the delta leaves alone must already be the new release's
+    for arcname, v in delta['files'].items():
+        if arcname in delta['patched'] or arcname in delta['added']:
+            continue
+        path = delta_path(install_path, arcname)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        if size != v['size'] or file_sha256(path) != v['sha256']:
+            raise DeltaError('%s is missing or modified'%path)
+
+def prepare_delta(delta, archive, install_path):
+    # new contents are written next to the installed files and verified
+    # against the manifest, returns (temp, path) pairs for commit_delta
+    prepared = []
+    try:
+        for arcname in delta['added'] + sorted(delta['patched']):
+            path = delta_path(install_path, arcname)
+            tmp = path + '.dpm-delta'
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            prepared.append((tmp, path))
+            with open(tmp, 'wb') as out:
+                if arcname in delta['patched']:
+                    with closing(archive.payload.open('diffs/' + arcname)) as f:
+                        patch(path, f, out)
+                else:
+                    with closing(archive.payload.open('files/' + arcname)) as f:
+                        shutil.copyfileobj(f, out, 2**20)
+            expected = delta['files'][arcname]
+            if file_sha256(tmp) != expected['sha256']:
+                raise DeltaError('Checksum mismatch for %s'%path)
+            os.chmod(tmp, expected['mode'] or 0o644)
+    except:
+        discard_delta(prepared)
+        raise
+    return prepared
+
+def discard_delta(prepared):
+    for tmp, path in prepared:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def commit_delta(delta, archive, install_path, prepared):
+    # returns the installed paths
+    for tmp, path in prepared:
+        os.replace(tmp, path)
+    for arcname in delta['removed']:
+        path = delta_path(install_path, arcname)
+        if os.path.lexists(path):
+            log.debug('removing: %s', path)
+            os.remove(path)
+        # folders left empty
+        folder = os.path.dirname(path)
+        while folder != os.path.normpath(install_path) and \
+                os.path.isdir(folder) and \
+                not os.listdir(folder):
+            os.rmdir(folder)
+            folder = os.path.dirname(folder)
+
+    addon = [v for v in archive.addon.namelist() if v != delta_name]
+    for name in addon:
+        archive.addon.extract(name, install_path)
+
+    install_list = [install_path]
+    folders = set()
+    for arcname in sorted(delta['files']):
+        parts = arcname.split('/')
+        for i in range(1, len(parts)):
+            folder = os.path.join(install_path, *parts[:i])
+            if folder not in folders:
+                folders.add(folder)
+                install_list.append(folder)
+        install_list.append(delta_path(install_path, arcname))
+    install_list.extend(os.path.join(install_path, v) for v in addon)
+    return install_list
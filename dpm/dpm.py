@@ -1,16 +1,52 @@
 
 import sys
 import logging
-from . import install
-from . import build
-from . import version
-from .utils import parser, log
+import argparse
+from importlib import import_module
+from collections import OrderedDict
+from .utils import parser
+from . import profile
+
+# command -> module registering its parser, imported only when it runs
+commands = OrderedDict([
+    ('install', 'install'),
+    ('uninstall', 'uninstall'),
+    ('autoremove', 'uninstall'),
+    ('rollback', 'rollback'),
+    ('lock', 'lock'),
+    ('why', 'graph'),
+    ('rdeps', 'graph'),
+    ('build', 'build'),
+    ('gc', 'store'),
+    ('purge', 'trash'),
+    ('version', 'version'),
+])
+
+def command_name(argv):
+    # global options taking a value must be listed here
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument('--trace')
+    pre.add_argument('--cprofile')
+    pre.add_argument('command', nargs='?')
+    return pre.parse_known_args(argv)[0].command
+
+def load_commands(argv):
+    name = command_name(argv)
+    if name in commands:
+        modules = [commands[name]]
+    else:
+        # help or a bad command, list all of them
+        modules = commands.values()
+    for v in modules:
+        import_module('.' + v, __package__)
 
 def main():
+    load_commands(sys.argv[1:])
     args = parser.parse_args()
     if getattr(args, 'verbose', False):
         level = logging.DEBUG
     else:
         level = logging.INFO
     logging.basicConfig(level = level, format='%(message)s')
-    args.func(args)
\ No newline at end of file
+    profile.run(args.func, args, summary_table=args.profile, trace=args.trace,
+        stats=args.cprofile)
@@ -0,0 +1,121 @@
+import sys
+from collections import deque
+from .utils import *
+from . import db
+
+class GraphError(Exception):
+    def __str__(self):
+        return 'GraphError: ' + Exception.__str__(self)
+
+class DependencyGraph:
+    # installed packages and their dependencies, read from the db at once
+
+    def __init__(self, packages, edges):
+        # packages: {name: auto}, edges: (package, dependency) pairs
+        self.auto = dict(packages)
+        self.deps = {v: set() for v in self.auto}
+        self.rdeps = {v: set() for v in self.auto}
+        for package, dependency in edges:
+            # dependencies not installed are left out
+            if package in self.auto and dependency in self.auto:
+                self.deps[package].add(dependency)
+                self.rdeps[dependency].add(package)
+
+    @classmethod
+    def load(cls):
+        return cls(*db.get_graph())
+
+    def check(self, name):
+        if name not in self.auto:
+            raise GraphError('Package %s not installed'%name)
+
+    def closure(self, names, edges):
+        seen = set(names)
+        pending = deque(names)
+        while pending:
+            for v in edges[pending.popleft()]:
+                if v not in seen:
+                    seen.add(v)
+                    pending.append(v)
+        return seen
+
+    def required(self):
+        # explicitly installed packages and everything they depend on
+        return self.closure([v for v, auto in self.auto.items() if not auto],
+            self.deps)
+
+    def orphans(self):
+        return set(self.auto) - self.required()
+
+    def reverse_deps(self, name, recursive=False):
+        self.check(name)
+        if not recursive:
+            return set(self.rdeps[name])
+        return self.closure([name], self.rdeps) - set([name])
+
+    def why(self, name):
+        # shortest chain from each explicitly installed package to name
+        self.check(name)
+        parent = {name: None}
+        pending = deque([name])
+        chains = []
+        while pending:
+            v = pending.popleft()
+            if not self.auto[v]:
+                chain = [v]
+                while parent[chain[-1]] is not None:
+                    chain.append(parent[chain[-1]])
+                chains.append(chain)
+            for w in sorted(self.rdeps[v]):
+                if w not in parent:
+                    parent[w] = v
+                    pending.append(w)
+        return chains
+
+    def removal_order(self, names):
+        # dependents before their dependencies
+        left = set(names)
+        order = []
+        while left:
+            ready = sorted(v for v in left if not self.rdeps[v] & left)
+            if not ready:
+                # dependency cycle
+                ready = sorted(left)[:1]
+            order.extend(ready)
+            left.difference_update(ready)
+        return order
+
+def why(args):
+    try:
+        graph = DependencyGraph.load()
+        chains = graph.why(args.package)
+    except GraphError as e:
+        log.error(str(e))
+        sys.exit(1)
+    if not chains:
+        print('%s is not required by any explicitly installed package'%
+            args.package)
+    for chain in chains:
+        if len(chain) == 1:
+            print('%s is installed explicitly'%args.package)
+        else:
+            print(' -> '.join(chain))
+
+def rdeps(args):
+    try:
+        names = DependencyGraph.load().reverse_deps(args.package,
+            args.recursive)
+    except GraphError as e:
+        log.error(str(e))
+        sys.exit(1)
+    for name in sorted(names):
+        print(name)
+
+parser = subparsers.add_parser('why', help='show why a package is installed')
+parser.set_defaults(func=why)
+parser.add_argument('package')
+
+parser = subparsers.add_parser('rdeps', help='list installed packages depending on a package')
+parser.set_defaults(func=rdeps)
+parser.add_argument('package')
+parser.add_argument('-r', '--recursive', action='store_true', help="include indirect dependents")
@@ -1,24 +1,25 @@
-import json
 import os
-import requests
 import tempfile
-import platform
-import re
 import sys
-import progressbar
 import shutil
-import subprocess
-import shlex
-import yaml
-import rfc3987
-from distutils.version import LooseVersion
 from .utils import *
-from .uninstall import uninstall_package
-from contextlib import closing
-import zipfile
+from .utils import DownloadError
+from .uninstall import report_orphans
+from .archive import PackageArchive, file_sha256, is_targeted, member_path
+from . import db
+from .config import update_location
+from .store import get_store
+from .profile import span, traced, annotate, count
+from .trash import (has_trash, purge_trash_background, discard_previous,
+    swap_release)
+from .delta import (DeltaError, read_delta, check_delta, prepare_delta,
+    discard_delta, commit_delta)
 import glob
+import json
 import logging
 import traceback
+from urllib.parse import urljoin
+from collections import OrderedDict
 
 class InstallError(Exception):
     def __str__(self):
@@ -27,16 +28,24 @@ class InstallError(Exception):
 temp = []
 packages = []
 
+lockfile_version = 1
+
 def install(args):
+    if has_trash():
+        purge_trash_background()
     try:
-        packages.extend(args.package)
-        del args.package
-        while packages:
-            package = packages.pop(0)
-            log.info('Installing %s'%package)
-            install_package(package, **vars(args))
+        if args.requirement:
+            install_lockfile(args.requirement, update=args.update,
+                force=args.force, jobs=args.jobs)
+        elif args.package:
+            packages.extend(args.package)
+            install_packages(args.package, update=args.update,
+                force=args.force, jobs=args.jobs)
+        else:
+            raise InstallError('No packages to install')
+        report_orphans()
         log.info('Success')
-    except InstallError as e:
+    except (InstallError, DownloadError) as e:
         log.debug(traceback.format_exc())
         log.error(str(e))
         sys.exit(1)
@@ -45,16 +54,18 @@ def install(args):
 
 parser = subparsers.add_parser('install', help='install package(s)')
 parser.set_defaults(func=install)
-parser.add_argument('package', nargs='+')
+parser.add_argument('package', nargs='*')
 parser.add_argument('-v', '--verbose', action='store_true', help="detailed output")
+parser.add_argument('-r', '--requirement', metavar='LOCKFILE', help="install the packages of a lockfile (see dpm lock)")
 parser.add_argument('-u', '--update', action='store_true', help="update installation")
 parser.add_argument('-f', '--force', action='store_true', help="force install")
+parser.add_argument('-j', '--jobs', type=int, default=4, help="number of packages processed concurrently")
 
 def install_state(name, release, update, force):
-    other_info = get_package_yaml(name, 'package.yaml')
+    other_info = db.get_package(name)
     if other_info:
         if not force:
-            if other_info['release'] == release:
+            if other_info['package_info']['release'] == release:
                 log.info('Package %s already installed', name)
                 return 1
             if not update:
@@ -63,152 +74,388 @@ def install_state(name, release, update, force):
         return -1
     return 0
 
-
-def install_package(package, force = False,
-        update = False, **kwargs):
-
-    if not os.path.exists(package):
-        try:
-            rfc3987.parse(package, rule='IRI')
-        except ValueError:
-            name, release, machine = info_from_name(package)
-            if release == 'latest':
-                # query server for latest release
-                raise InstallError('Not implemented')
-            status = install_state(name, release, update, force)
-            if status > 0:
-                return
-            for i, v in enumerate(packages):
-                if os.path.exists(v):
-                    with closing(zipfile.ZipFile(v, 'r')) as z:
-                        with closing(z.open('package.yaml', 'r')) as f:
-                            info = yaml.load(f)
-                            if info['name'] == name and \
-                                    info['release'] == release:
-                                package = packages.pop(i)
-                                break
-            else:
-                # download actual package
-                raise InstallError('Not implemented')
+_info_cache = {}
+
+@traced('read_package_info')
+def read_package_info(package):
+    # memoized per file version, find_package reads every local archive
+    st = os.stat(package)
+    key = (os.path.abspath(package), st.st_mtime_ns, st.st_size)
+    info = _info_cache.get(key)
+    if info is None:
+        with PackageArchive(package) as archive:
+            info = archive.package_info, archive.install_info
+        _info_cache[key] = info
+    return info
+
+def find_package(package, update = False, force = False,
+        skip_installed = True):
+    if os.path.exists(package):
+        return package
+    name, release, machine = info_from_name(package)
+    if release == 'latest':
+        # query server for latest release
+        raise InstallError('Not implemented')
+    if skip_installed:
+        status = install_state(name, release, update, force)
+        if status > 0:
+            return
+    for v in packages:
+        if os.path.exists(v):
+            info = read_package_info(v)[0]
+            if info['name'] == name and info['release'] == release:
+                return v
+    # download actual package
+    raise InstallError('Not implemented')
+
+def fetch_packages(specs, update = False, jobs = 1, skip_installed = True):
+    urls = [spec for spec, force in specs if is_url(spec)]
+    if urls:
+        target_dir = tempfile.mkdtemp('-dpm')
+        temp.append(target_dir)
+        downloaded = dict(zip(urls, download_many(target_dir, urls, jobs=jobs)))
+    for spec, force in specs:
+        if spec in urls:
+            yield spec, force, downloaded[spec]
         else:
-            target_dir = tempfile.mkdtemp('-dpm')
-            temp.append(target_dir)
-            package = download(target_dir, package)
-
-
-
-    with open(package, 'rb') as f:
-        z = zipfile.ZipFile(f, 'r')
+            yield spec, force, find_package(spec, update, force,
+                skip_installed)
+
+@traced('resolve')
+def resolve_packages(specs, update = False, force = False, jobs = 1,
+        skip_installed = True):
+    # skip_installed=False resolves the whole graph, e.g. for a lockfile
+    graph = OrderedDict()
+    seen = set()
+    pending = [(v, force) for v in specs]
+    while pending:
+        wave = []
+        for spec, spec_force in pending:
+            key = info_from_name(spec)[0]
+            if key not in seen and key not in graph:
+                seen.add(key)
+                wave.append((spec, spec_force))
+        pending = []
+        for spec, spec_force, package in fetch_packages(wave, update, jobs,
+                skip_installed):
+            if package is None:
+                continue
+            package_info, install_info = read_package_info(package)
+            name = package_info['name']
+            if name in graph:
+                continue
+            status = 0
+            if skip_installed:
+                status = install_state(name, package_info['release'],
+                    update, spec_force)
+                if status > 0:
+                    continue
+            deps = install_info.get('dependencies') or []
+            if deps:
+                log.info('Package %s depends on:\n%s'%(name, '\n'.join(deps)))
+            graph[name] = dict(
+                spec=spec,
+                package=package,
+                status=status,
+                deps=[info_from_name(v)[0] for v in deps]
+            )
+            pending.extend((v, False) for v in deps)
+    return graph
+
+def install_packages(specs, force = False, update = False, jobs = 1):
+    from .pipeline import install_specs
+    install_specs(specs, force=force, update=update, jobs=jobs)
 
-        with closing(z.open('package.yaml', 'r')) as y:
-            package_info = yaml.load(y)
+def install_package(package, force = False,
+        update = False, jobs = 1, **kwargs):
+    install_packages([package], force=force, update=update, jobs=jobs)
 
-        with closing(z.open('install.yaml', 'r')) as y:
-            install_info = yaml.load(y)
+@traced('install_archive')
+def install_archive(package, status, update = False, jobs = 1, spec = None,
+        stream = None, auto = False):
+    # spec: what the package was given as, a delta finds its full
+    # package next to it; stream: StreamExtractor that extracted the
+    # package while it was downloaded; auto: installed as a dependency, None
+    # keeps the flag of the installed release
 
-        status = install_state(package_info['name'], package_info['release'], update, force)
+    with PackageArchive(package) as archive:
+        package_info = archive.package_info
+        install_info = archive.install_info
 
-        if status > 0:
-            return
+        name = package_info['name']
+        annotate(package=name)
 
-        deps = install_info.get('dependencies')
-        if deps:
-            log.info('Package %s depends on:\n%s\nInstalling...'%(package_info['name'],
-                '\n'.join(deps)))
-            for v in deps:
-                install_package(v, update = update)
+        installed = db.get_package(name) if status < 0 else None
 
-        install_path = get_install_path(package_info['name'])
-
-        log.debug('installing to: %s', install_path)
-
-        if status < 0:
-            uninstall_package(package_info['name'], other_deps = deps)
+        delta = read_delta(archive)
+        if delta is not None:
+            return install_delta(archive, delta, installed, status, update,
+                jobs, spec, auto)
 
         install_list = []
-        if not os.path.exists(install_path):
-            os.makedirs(install_path)
+        if installed:
+            # the new release is prepared next to the installed one and
+            # swapped in when ready
+            install_path = installed['install_path']
+            dest_path = tempfile.mkdtemp(prefix='.dpm-new-',
+                dir=os.path.dirname(install_path))
+            temp.append(dest_path)
             install_list.append(install_path)
+        else:
+            install_path = get_install_path(name)
+            dest_path = install_path
+            if not os.path.exists(install_path):
+                os.makedirs(install_path)
+                install_list.append(install_path)
+                update_location(name, install_path)
 
-        package_path = tempfile.mkdtemp('-dpm')
-        temp.append(package_path)
-
-        files = install_info.get('targets', [])
-        log.debug('Exctracting archive to: %s', package_path)
-
-        for name in z.namelist():
-            log.debug('Exctracting: %s', name)
-            files.append(name)
-            z.extract(name, package_path)
-
-        end = z.infolist()[0].header_offset
-
-        _seek = f.seek
-        def seek_hook(offset, whence = 0):
-            if whence == 2:
-                offset = end + offset
-                whence = 0
-            _seek(offset, whence)
-        f.seek = seek_hook
-        _read = f.read
-        def read_hook(size = -1):
-            if size == -1:
-                size = end - f.tell()
-            return _read(size) 
-        f.read = read_hook
-        y = z
-        z = zipfile.ZipFile(f, 'r')
-        for name in z.namelist():
-            log.debug('Exctracting: %s', name)
-            z.extract(name, package_path)
-
+        log.debug('installing to: %s', install_path)
+        store = get_store()
+        hashes = {}
+
+        files = install_info.get('targets', []) + archive.addon.namelist()
+        package_path = None
+        if stream is not None and stream_usable(stream, archive, install_path):
+            log.debug('Using streamed extraction in: %s', stream.root)
+            package_path = stream.root
+        elif (install_info.get('pre_install') or install_info.get('post_install')
+                or os.listdir(dest_path)):
+            # staging next to the install path, so targets are renamed
+            # into place
+            package_path = tempfile.mkdtemp(prefix='.dpm-staging-',
+                dir=os.path.dirname(install_path))
+            temp.append(package_path)
+            log.debug('Exctracting archive to: %s', package_path)
+            with span('extract'):
+                archive.extractall(package_path)
+        else:
+            # no hook needs the package tree, targets are extracted straight
+            # into place and other members aren't written at all
+            if installed:
+                pre_uninstall(installed, jobs)
+            log.debug('Exctracting targets to: %s', dest_path)
+            with span('extract'):
+                keys = extract_targets(archive, files, dest_path, store)
+            for path, key in keys.items():
+                path_rel = os.path.relpath(path, dest_path)
+                hashes[os.path.join(install_path, path_rel)] = key
+            for root, dirnames, filenames in os.walk(dest_path):
+                for fname in dirnames + filenames:
+                    path_rel = os.path.relpath(os.path.join(root, fname),
+                        dest_path)
+                    install_list.append(os.path.join(install_path, path_rel))
+
+    if package_path is not None:
+        install_staged(install_info, files, package_path, install_path,
+            dest_path, install_list, hashes, store, jobs, installed)
+
+    if not installed:
+        with span('db'):
+            db.add_package(package_info, install_info, install_path,
+                install_list, hashes, auto)
+        return
+
+    old_hashes = db.get_hashes(name)
+    previous = db.get_previous(name)
+    with span('swap'):
+        discard_previous(install_path, previous['files'] if previous else ())
+        log.debug('swapping in: %s', dest_path)
+        swap_release(install_path, dest_path)
+    with span('db'):
+        db.replace_package(package_info, install_info, install_path,
+            install_list, hashes, auto)
+    if store:
+        store.release(old_hashes)
+    log.info('%s %s replaced by %s', name, installed['release'],
+        package_info['release'])
+
+def stream_usable(stream, archive, install_path):
+    # targets are renamed from the streamed tree, it has to be on the same
+    # filesystem and complete
+    if os.path.dirname(stream.root) != os.path.dirname(install_path):
+        return False
+    if not stream.verify(archive):
+        log.debug('Streamed extraction of %s incomplete', archive.path)
+        return False
+    return True
+
+def extract_targets(archive, files, dest_path, store = None):
+    # returns {path: store key} of stored files
+    keys = {}
+    for z, info in archive.members(lambda v: is_targeted(v, files)):
+        path = member_path(dest_path, info.filename)
+        log.debug('installing: %s', path)
+        if store and not info.is_dir():
+            part = path + '.dpm-part'
+            archive.extract_member(z, info, part)
+            store.install_file(part, path, keys)
+        else:
+            archive.extract_member(z, info, path)
+    return keys
+
+def pre_uninstall(installed, jobs = 1):
+    with span('pre_uninstall'):
+        if not run_commands(installed['install_info'].get('pre_uninstall', ()),
+                cwd=installed['install_path'], jobs=jobs):
+            raise InstallError('Pre-uninstall command error.')
+
+def install_staged(install_info, files, package_path, install_path, dest_path,
+        install_list, hashes, store, jobs = 1, installed = None):
+    # hooks run on the extracted package, then targets are moved to dest_path;
+    # they are linked to the store once post_install can't write to them.
+    # The release being replaced is uninstalled after pre_install
     variables = dict(
             source=package_path,
             dest=install_path,
+            staging=dest_path,
             python=sys.executable,
             platform=platform_name,
             arch=platform_arch,
             system=system_name
         )
 
-    for v in install_info.get('pre_install', ()):
-        if not run_process(command=v, cwd=package_path, format_kwargs=variables):
+    with span('pre_install'):
+        if not run_commands(install_info.get('pre_install', ()), cwd=package_path,
+                format_kwargs=variables, jobs=jobs):
             raise InstallError('Pre-install command error.')
 
-    for v in files:
-        for item in glob.iglob(os.path.join(package_path, v)):
-            path_rel = os.path.relpath(item, package_path)
-            install_to = os.path.join(install_path, path_rel)
-            install_list.append(install_to)
-            if os.path.isdir(item):
-                for root, dirnames, filenames in os.walk(item):
-                    for name in dirnames + filenames:
-                        path = os.path.join(root, name)
-                        path_rel = os.path.relpath(path, package_path)
-                        install_list.append(os.path.join(install_path, path_rel))
-            log.debug('installing: %s', install_to)
-            shutil.move(item, install_to)
-
-    for v in install_info.get('post_install', ()):
-        if not run_process(command=v, cwd=package_path, format_kwargs=variables):
+    if installed:
+        pre_uninstall(installed, jobs)
+
+    moved = []
+    with span('move'):
+        for v in files:
+            for item in glob.iglob(os.path.join(package_path, v)):
+                path_rel = os.path.relpath(item, package_path)
+                install_to = os.path.join(dest_path, path_rel)
+                install_list.append(os.path.join(install_path, path_rel))
+                if os.path.isdir(item):
+                    for root, dirnames, filenames in os.walk(item):
+                        for fname in dirnames + filenames:
+                            path = os.path.join(root, fname)
+                            path_rel = os.path.relpath(path, package_path)
+                            install_list.append(os.path.join(install_path, path_rel))
+                log.debug('installing: %s', install_to)
+                if os.path.isdir(install_to) and not os.path.islink(install_to):
+                    log.warning('Replacing existing %s', install_to)
+                    shutil.rmtree(install_to)
+                os.makedirs(os.path.dirname(install_to), exist_ok=True)
+                os.replace(item, install_to)
+                moved.append(install_to)
+        count(files=len(install_list))
+
+    with span('post_install'):
+        if not run_commands(install_info.get('post_install', ()), cwd=package_path,
+                format_kwargs=variables, jobs=jobs):
             raise InstallError('Post-install command error.')
 
-    if deps:
-        for v in deps:
-            name = info_from_name(v)[0]
-            deps_list = get_package_list(name, 'deps.txt')
-            if package_info['name'] not in deps_list:
-                deps_list.append(package_info['name'])
-                save_package_list(name, 'deps.txt', deps_list)
+    if store:
+        with span('store'):
+            for install_to in moved:
+                for path, key in store.adopt(install_to).items():
+                    path_rel = os.path.relpath(path, dest_path)
+                    hashes[os.path.join(install_path, path_rel)] = key
+
+@traced('install_delta')
+def install_delta(archive, delta, installed, status, update, jobs, spec,
+        auto = False):
+    package_info = archive.package_info
+    install_info = archive.install_info
+    name = package_info['name']
+    try:
+        if not installed:
+            raise DeltaError('%s is not installed'%name)
+        install_path = installed['install_path']
+        with span('check'):
+            check_delta(delta, archive, installed)
+        with span('prepare'):
+            prepared = prepare_delta(delta, archive, install_path)
+    except DeltaError as e:
+        log.info('%s, installing the full package', e)
+        return install_archive(fetch_full(delta, archive.path, spec), status,
+            update, jobs, auto=auto)
 
-    install_list.append(os.path.join(install_path, 'deps.txt'))
-    install_list.append(os.path.join(install_path, 'files.txt'))
+    try:
+        pre_uninstall(installed, jobs)
+    except:
+        discard_delta(prepared)
+        raise
+
+    old_hashes = db.get_file_hashes(name)
+    previous = db.get_previous(name)
+    discard_previous(install_path, previous['files'] if previous else ())
+    with span('commit'):
+        install_list = commit_delta(delta, archive, install_path, prepared)
+    count(files=len(prepared))
+    # store links of untouched files are kept
+    changed = set(os.path.join(install_path, v)
+        for v in delta['added'] + list(delta['patched']) + delta['removed'])
+    hashes = {k: v for k, v in old_hashes.items() if k not in changed}
+    with span('db'):
+        db.patch_package(package_info, install_info, install_path,
+            install_list, hashes, auto)
+    store = get_store()
+    if store:
+        store.release(list(set(old_hashes.values())))
+    log.info('%s %s patched to %s', name, installed['release'],
+        package_info['release'])
+
+def fetch_full(delta, package, spec = None):
+    # the full package of a delta, from the same folder or URL
+    full = delta['full']
+    if spec and is_url(spec):
+        target_dir = tempfile.mkdtemp('-dpm')
+        temp.append(target_dir)
+        return download(target_dir, urljoin(spec, full['name']),
+            checksum=full['sha256'])
+    path = os.path.join(os.path.dirname(package), full['name'])
+    if not os.path.isfile(path):
+        raise InstallError('Full package %s not found'%path)
+    if file_sha256(path) != full['sha256']:
+        raise InstallError('Checksum mismatch for %s'%path)
+    return path
+
+def install_lockfile(path, update = False, force = False, jobs = 1):
+    # no resolution, entries carry their dependencies and checksums;
+    # entries no other one depends on count as explicitly installed
+    graph = OrderedDict()
+    entries = load_lockfile(path)
+    required = set(v for entry in entries
+        for v in entry.get('dependencies', []))
+    for entry in entries:
+        if entry.get('platform', platform_name) != platform_name:
+            raise InstallError('Lockfile entry %s is for %s, not %s'%(
+                entry['name'], entry['platform'], platform_name))
+    for entry in entries:
+        status = install_state(entry['name'], entry['release'], update, force)
+        if status > 0:
+            if entry['name'] not in required:
+                db.set_auto(entry['name'], False)
+            continue
+        graph[entry['name']] = dict(
+            spec=entry.get('url') or entry['path'],
+            entry=entry,
+            status=status,
+            deps=entry.get('dependencies', []),
+            auto=entry['name'] in required
+        )
+    from .pipeline import install_locked
+    install_locked(graph, update=update, jobs=jobs)
 
-    save_package_list(package_info['name'], 'deps.txt', [])
-    save_package_list(package_info['name'], 'files.txt', install_list)
+def load_lockfile(path):
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise InstallError('Can\'t read lockfile %s: %s'%(path, e))
+    if data.get('version') != lockfile_version:
+        raise InstallError('Unsupported lockfile version: %s'%
+            data.get('version'))
+    return data['packages']
 
 def cleanup():
     log.info('Cleanup')
     for folder in temp:
-        log.debug('Removing %s', folder)
-        shutil.rmtree(folder)
+        if os.path.exists(folder):
+            log.debug('Removing %s', folder)
+            shutil.rmtree(folder)
@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from .utils import *
+from .utils import DownloadError
+from .archive import file_sha256
+from .install import (InstallError, packages, resolve_packages,
+    read_package_info, lockfile_version, cleanup)
+
+def lock(args):
+    try:
+        packages.extend(args.package)
+        graph = resolve_packages(args.package, jobs=args.jobs,
+            skip_installed=False)
+        entries = lock_entries(graph, args.jobs)
+        tmp = args.output + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(version=lockfile_version, packages=entries), f,
+                indent=2)
+            f.write('\n')
+        os.replace(tmp, args.output)
+        log.info('Locked %i packages in %s', len(entries), args.output)
+    except (InstallError, DownloadError) as e:
+        log.debug(traceback.format_exc())
+        log.error(str(e))
+        sys.exit(1)
+    finally:
+        cleanup()
+
+parser = subparsers.add_parser('lock', help='write a lockfile of package(s) and their dependencies')
+parser.set_defaults(func=lock)
+parser.add_argument('package', nargs='+')
+parser.add_argument('-v', '--verbose', action='store_true', help="detailed output")
+parser.add_argument('-o', '--output', default='dpm.lock', help="lockfile path (default: dpm.lock)")
+parser.add_argument('-j', '--jobs', type=int, default=4, help="number of parallel downloads")
+
+def install_order(graph):
+    # dependencies first
+    order = []
+    state = {}
+    def visit(name):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise InstallError('Circular dependencies with: %s'%name)
+        state[name] = 'visiting'
+        for v in graph[name]['deps']:
+            if v in graph:
+                visit(v)
+        state[name] = 'done'
+        order.append(name)
+    for name in graph:
+        visit(name)
+    return order
+
+def package_platform(path, package_info):
+    # build names packages <name>-<release>-<platform>.zip
+    prefix = '%s-%s-'%(package_info['name'].replace('/', '-'),
+        package_info['release'])
+    fname, ext = os.path.splitext(os.path.basename(path))
+    if fname.startswith(prefix):
+        return fname[len(prefix):]
+    return platform_name
+
+def lock_entries(graph, jobs = 1):
+    order = install_order(graph)
+    with ThreadPoolExecutor(max(jobs, 1)) as pool:
+        checksums = list(pool.map(file_sha256,
+            [graph[v]['package'] for v in order]))
+    entries = []
+    for name, checksum in zip(order, checksums):
+        node = graph[name]
+        package_info = read_package_info(node['package'])[0]
+        entry = dict(
+            name=name,
+            release=package_info['release'],
+            platform=package_platform(node['package'], package_info),
+            sha256=checksum,
+            size=os.path.getsize(node['package']),
+            dependencies=[v for v in node['deps'] if v in graph]
+        )
+        if is_url(node['spec']):
+            entry['url'] = node['spec']
+        else:
+            entry['path'] = os.path.abspath(node['package'])
+        entries.append(entry)
+    return entries
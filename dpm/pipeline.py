@@ -0,0 +1,243 @@
+import os
+import asyncio
+import tempfile
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .utils import *
+from .utils import Progress
+from .archive import StreamExtractor, file_sha256
+from .config import get_install_path, get_packages_dirs
+from . import db
+from .install import (InstallError, temp, install_state, find_package,
+    read_package_info, install_archive)
+
+class Pipeline:
+    # installs a dependency graph while it is fetched: downloads are
+    # extracted as they arrive and a package is installed as soon as its
+    # dependencies are, while other packages are still downloading.
+    # Blocking work runs on a thread pool, at most `jobs` downloads and
+    # `jobs` installs at a time
+
+    def __init__(self, update = False, jobs = 1):
+        self.update = update
+        self.jobs = max(jobs, 1)
+        self.graph = OrderedDict()
+        self.done = {}
+        self.tasks = []
+        self.progress = None
+        self.target_dir = None
+        # names asked for and names other packages depend on
+        self.roots = set()
+        self.required = set()
+
+    def run(self, main):
+        loop = asyncio.new_event_loop()
+        # download and extraction of each package take a thread
+        self.pool = ThreadPoolExecutor(self.jobs * 3)
+        try:
+            return loop.run_until_complete(self.supervise(main))
+        finally:
+            self.pool.shutdown()
+            loop.close()
+            if self.progress is not None:
+                self.progress.finish()
+
+    async def supervise(self, main):
+        self.downloads = asyncio.Semaphore(self.jobs)
+        self.installs = asyncio.Semaphore(self.jobs)
+        try:
+            await main
+            # no package left to resolve, dependencies not in the graph
+            # are installed already
+            for name in list(self.done):
+                if name not in self.graph:
+                    self.finished(name)
+            self.check_cycles()
+            await asyncio.gather(*self.tasks)
+        except:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            raise
+
+    def blocking(self, func, *args, **kwargs):
+        return asyncio.get_event_loop().run_in_executor(self.pool,
+            partial(func, *args, **kwargs))
+
+    def future(self, name):
+        # set once the package is installed or known to need no install
+        if name not in self.done:
+            self.done[name] = asyncio.get_event_loop().create_future()
+        return self.done[name]
+
+    def finished(self, name):
+        future = self.future(name)
+        if not future.done():
+            future.set_result(None)
+
+    def check_cycles(self):
+        left = {name: set(v for v in node['deps'] if v in self.graph)
+            for name, node in self.graph.items() if not self.future(name).done()}
+        while left:
+            ready = [name for name, deps in left.items()
+                if not deps & set(left)]
+            if not ready:
+                raise InstallError('Circular dependencies between: %s'%
+                    ', '.join(left))
+            for name in ready:
+                del left[name]
+
+    def stream_root(self, name = None):
+        # next to the install path, so targets can be renamed into place
+        installed = db.get_package(name) if name else None
+        if installed:
+            parent = os.path.dirname(installed['install_path'])
+        elif name:
+            parent = os.path.dirname(get_install_path(name))
+        else:
+            parent = get_packages_dirs()[-1]
+        os.makedirs(parent, exist_ok=True)
+        root = tempfile.mkdtemp(prefix='.dpm-stream-', dir=parent)
+        temp.append(root)
+        return root
+
+    async def download(self, url, checksum = None, name = None):
+        # returns the downloaded package and its StreamExtractor
+        async with self.downloads:
+            if self.target_dir is None:
+                self.target_dir = tempfile.mkdtemp('-dpm')
+                temp.append(self.target_dir)
+            if self.progress is None:
+                self.progress = Progress()
+            stream = StreamExtractor(self.stream_root(name))
+            downloading = self.blocking(download, self.target_dir, url,
+                progress=self.progress, checksum=checksum, sink=stream.feed)
+            extracting = self.blocking(stream.run)
+            try:
+                package = await downloading
+            finally:
+                stream.close()
+                await extracting
+        return package, stream
+
+    def start(self, name, node):
+        self.graph[name] = node
+        self.tasks.append(asyncio.ensure_future(self.install(name, node)))
+
+    async def install(self, name, node):
+        for dep in node['deps']:
+            await self.future(dep)
+        async with self.installs:
+            log.info('Installing %s', name)
+            await self.blocking(install_archive, node['package'],
+                node['status'], self.update, self.jobs, spec=node.get('spec'),
+                stream=node.get('stream'), auto=node.get('auto'))
+        self.finished(name)
+
+    async def fetch_spec(self, spec, force, auto = False):
+        if is_url(spec):
+            return await self.download(spec)
+        package = await self.blocking(find_package, spec, self.update, force)
+        if package is None:
+            # installed already
+            name = info_from_name(spec)[0]
+            if not auto:
+                self.roots.add(name)
+            self.finished(name)
+        return package, None
+
+    async def resolve(self, specs, force = False):
+        # waves of dependencies like resolve_packages, each package is
+        # installed once it's fetched and its dependencies are done
+        # auto: pulled in as a dependency, not asked for
+        seen = set()
+        pending = [(v, force, False) for v in specs]
+        while pending:
+            wave = []
+            for spec, spec_force, auto in pending:
+                key = info_from_name(spec)[0]
+                if key not in seen and key not in self.graph:
+                    seen.add(key)
+                    wave.append((spec, spec_force, auto))
+            pending = []
+            fetches = [self.fetch_wave_spec(*v) for v in wave]
+            for fetch in asyncio.as_completed(fetches):
+                spec, spec_force, auto, (package, stream) = await fetch
+                if package is None:
+                    continue
+                package_info, install_info = await self.blocking(
+                    read_package_info, package)
+                name = package_info['name']
+                if name in self.graph:
+                    continue
+                status = install_state(name, package_info['release'],
+                    self.update, spec_force)
+                if not auto:
+                    self.roots.add(name)
+                if status > 0:
+                    self.finished(name)
+                    continue
+                deps = install_info.get('dependencies') or []
+                if deps:
+                    log.info('Package %s depends on:\n%s'%(name, '\n'.join(deps)))
+                self.start(name, dict(
+                    spec=spec,
+                    package=package,
+                    stream=stream,
+                    status=status,
+                    deps=[info_from_name(v)[0] for v in deps],
+                    # roots keep their flag until mark_roots
+                    auto=True if auto else None
+                ))
+                self.required.update(info_from_name(v)[0] for v in deps)
+                pending.extend((v, False, True) for v in deps)
+
+    def mark_roots(self):
+        # dependencies are given next to the packages needing them, those
+        # stay automatically installed; other roots become explicit
+        for name in self.roots:
+            if name not in self.required:
+                db.set_auto(name, False)
+            elif name in self.graph and self.graph[name]['status'] == 0:
+                db.set_auto(name, True)
+
+    async def fetch_wave_spec(self, spec, force, auto):
+        return spec, force, auto, await self.fetch_spec(spec, force, auto)
+
+    async def fetch_locked(self, name, node):
+        entry = node['entry']
+        if entry.get('url'):
+            node['package'], node['stream'] = await self.download(
+                entry['url'], entry['sha256'], name)
+            return
+        checksum = await self.blocking(file_sha256, entry['path'])
+        if checksum != entry['sha256']:
+            raise InstallError('Checksum mismatch for %s: expected %s, '
+                'got %s'%(entry['path'], entry['sha256'], checksum))
+        node['package'] = entry['path']
+
+    async def install_locked(self, name, node):
+        await self.fetch_locked(name, node)
+        await self.install(name, node)
+
+    async def locked(self, graph):
+        # the lockfile graph is complete, fetches all start at once
+        for name, node in graph.items():
+            self.graph[name] = node
+            self.tasks.append(asyncio.ensure_future(
+                self.install_locked(name, node)))
+        # dependencies left out of the graph are installed already
+        for node in graph.values():
+            for dep in node['deps']:
+                if dep not in graph:
+                    self.finished(dep)
+
+def install_specs(specs, force = False, update = False, jobs = 1):
+    pipeline = Pipeline(update=update, jobs=jobs)
+    pipeline.run(pipeline.resolve(specs, force))
+    pipeline.mark_roots()
+
+def install_locked(graph, update = False, jobs = 1):
+    pipeline = Pipeline(update=update, jobs=jobs)
+    pipeline.run(pipeline.locked(graph))
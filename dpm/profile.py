@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+# spans are recorded only with "dpm --profile" or "dpm --trace FILE"
+enabled = False
+
+_spans = []
+_lock = threading.Lock()
+_local = threading.local()
+_origin = time.perf_counter()
+
+class Span:
+    __slots__ = ('name', 'args', 'counters', 'thread', 'start', 'end',
+        'child_time')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.counters = {}
+        self.thread = threading.current_thread()
+        self.start = time.perf_counter()
+        self.end = None
+        self.child_time = 0
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+@contextmanager
+def span(name, **args):
+    if not enabled:
+        yield
+        return
+    s = Span(name, args)
+    stack = _stack()
+    stack.append(s)
+    try:
+        yield s
+    finally:
+        s.end = time.perf_counter()
+        stack.pop()
+        if stack:
+            stack[-1].child_time += s.duration
+        with _lock:
+            _spans.append(s)
+
+def traced(name):
+    # the whole call as a span
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def annotate(**args):
+    # arguments of the innermost span of this thread
+    if enabled:
+        stack = _stack()
+        if stack:
+            stack[-1].args.update(args)
+
+def count(**counters):
+    # adds to counters (bytes, files, ...) of the innermost span of this thread
+    if enabled:
+        stack = _stack()
+        if stack:
+            values = stack[-1].counters
+            for k, v in counters.items():
+                values[k] = values.get(k, 0) + v
+
+def enable():
+    global enabled
+    enabled = True
+
+def trace_events():
+    pid = os.getpid()
+    events = []
+    threads = {}
+    with _lock:
+        spans = list(_spans)
+    for s in spans:
+        threads[s.thread.ident] = s.thread.name
+        args = {k: str(v) for k, v in s.args.items()}
+        args.update(s.counters)
+        events.append(dict(name=s.name, cat='dpm', ph='X', pid=pid,
+            tid=s.thread.ident, ts=(s.start - _origin) * 1e6,
+            dur=s.duration * 1e6, args=args))
+    for tid, name in threads.items():
+        events.append(dict(name='thread_name', ph='M', pid=pid, tid=tid,
+            args=dict(name=name)))
+    return events
+
+def write_trace(path):
+    # chrome://tracing and Perfetto read this
+    with open(path, 'w') as f:
+        json.dump(dict(traceEvents=trace_events(), displayTimeUnit='ms'), f)
+
+def summary():
+    totals = {}
+    with _lock:
+        spans = list(_spans)
+    for s in spans:
+        v = totals.setdefault(s.name, dict(calls=0, total=0, self=0,
+            bytes=0, files=0))
+        v['calls'] += 1
+        v['total'] += s.duration
+        v['self'] += s.duration - s.child_time
+        v['bytes'] += s.counters.get('bytes', 0)
+        v['files'] += s.counters.get('files', 0)
+    lines = ['%-24s %6s %10s %10s %10s %8s'%
+        ('span', 'calls', 'total s', 'self s', 'MiB', 'files')]
+    for name, v in sorted(totals.items(), key=lambda v: -v[1]['total']):
+        lines.append('%-24s %6i %10.3f %10.3f %10.2f %8i'%(name[:24],
+            v['calls'], v['total'], v['self'], v['bytes'] / 2**20, v['files']))
+    return '\n'.join(lines) + '\n'
+
+def run(func, args, summary_table=False, trace=None, stats=None):
+    # stats: cProfile dump of the main thread and every thread started
+    # meanwhile (pools, pipeline, hook runners)
+    if summary_table or trace:
+        enable()
+    profiles = []
+    if stats:
+        import cProfile
+        def thread_profile(frame, event, arg):
+            # first event of a new thread, the profiler replaces this hook
+            prof = cProfile.Profile()
+            with _lock:
+                profiles.append(prof)
+            prof.enable()
+        threading.setprofile(thread_profile)
+        profiles.append(cProfile.Profile())
+        profiles[0].enable()
+    try:
+        with span(func.__name__):
+            func(args)
+    finally:
+        if profiles:
+            profiles[0].disable()
+            threading.setprofile(None)
+            import pstats
+            merged = pstats.Stats(profiles[0])
+            for prof in profiles[1:]:
+                prof.create_stats()
+                if prof.stats:
+                    merged.add(prof)
+            merged.dump_stats(stats)
+        if summary_table:
+            sys.stderr.write(summary())
+        if trace:
+            write_trace(trace)
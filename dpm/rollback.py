@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+from .utils import *
+from . import db
+from .trash import get_previous_path
+
+class RollbackError(Exception):
+    def __str__(self):
+        return 'RollbackError: ' + Exception.__str__(self)
+
+def rollback(args):
+    try:
+        for package in args.package:
+            rollback_package(package)
+        log.info('Success')
+    except RollbackError as e:
+        log.error(str(e))
+        sys.exit(1)
+
+parser = subparsers.add_parser('rollback', help='restore the previous release of package(s)')
+parser.set_defaults(func=rollback)
+parser.add_argument('package', nargs='+')
+parser.add_argument('-v', '--verbose', action='store_true', help="detailed output")
+
+def rollback_package(package):
+    installed = db.get_package(package)
+    if installed == None:
+        raise RollbackError('Package %s not installed'%package)
+    previous = db.get_previous(package)
+    install_path = installed['install_path']
+    previous_path = get_previous_path(install_path)
+    if previous == None or not os.path.isdir(previous_path):
+        raise RollbackError('No previous release of %s'%package)
+
+    # the releases swap places, so a second rollback undoes the first
+    swap_path = tempfile.mkdtemp(prefix='.dpm-rollback-',
+        dir=os.path.dirname(install_path))
+    os.rmdir(swap_path)
+    os.rename(install_path, swap_path)
+    try:
+        os.rename(previous_path, install_path)
+    except OSError:
+        os.rename(swap_path, install_path)
+        raise
+    os.rename(swap_path, previous_path)
+    db.rollback_package(package)
+    log.info('%s %s rolled back to %s', package, installed['release'],
+        previous['release'])
@@ -0,0 +1,67 @@
+import os
+import re
+import glob
+import fnmatch
+import logging
+
+log = logging.getLogger('dpm')
+
+class IgnoreMatcher:
+    # all fnmatch patterns compiled into a single regular expression
+
+    def __init__(self, patterns):
+        patterns = [os.path.normcase(os.path.normpath(v)) for v in patterns]
+        if patterns:
+            regex = '|'.join('(?:%s)'%fnmatch.translate(v) for v in patterns)
+            self.match = re.compile(regex).match
+        else:
+            self.match = lambda path: None
+
+    def __call__(self, path):
+        return self.match(os.path.normcase(path)) is not None
+
+def list_dir(path):
+    with os.scandir(path) as it:
+        return sorted(it, key=lambda v: v.name)
+
+class DirCache:
+    # list_dir of a tree scanned several times, DirEntry objects keep
+    # their stat results as well
+
+    def __init__(self):
+        self.entries = {}
+
+    def __call__(self, path):
+        entries = self.entries.get(path)
+        if entries is None:
+            entries = self.entries[path] = list_dir(path)
+        return entries
+
+def scan_dir(path, rel, ignored, listdir=list_dir):
+    # same order as a sorted topdown os.walk: the folder, its files,
+    # then its subfolders
+    yield path, rel, None
+    dirs = []
+    for entry in listdir(path):
+        entry_rel = os.path.join(rel, entry.name)
+        if ignored(entry_rel):
+            log.debug('ignored: %s', entry.path)
+        elif entry.is_dir():
+            if not entry.is_symlink():
+                dirs.append((entry.path, entry_rel))
+        else:
+            yield entry.path, entry_rel, entry
+    for v in dirs:
+        yield from scan_dir(v[0], v[1], ignored, listdir)
+
+def scan_targets(source_dir, patterns, ignored, listdir=list_dir):
+    # yields (path, path relative to source_dir, DirEntry or None)
+    for v in patterns:
+        for item in sorted(glob.glob(os.path.join(source_dir, v))):
+            rel = os.path.relpath(item, source_dir)
+            if ignored(rel):
+                log.debug('ignored: %s', item)
+            elif os.path.isdir(item):
+                yield from scan_dir(item, rel, ignored, listdir)
+            else:
+                yield item, rel, None
@@ -0,0 +1,180 @@
+import os
+import stat
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import threading
+from .config import get_config, get_packages_dirs
+from .utils import subparsers
+from . import db
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger('dpm')
+
+store_name = '.dpm-store'
+min_size = 4096
+gc_grace = 3600
+read_size = 2**20
+
+# linux/fs.h
+FICLONE = 0x40049409
+
+_store = None
+_store_lock = threading.Lock()
+
+def file_key(path, st):
+    # same content with another mode must not share an inode
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(read_size), b''):
+            h.update(chunk)
+    return '%s-%o'%(h.hexdigest(), stat.S_IMODE(st.st_mode))
+
+def reflink(src, dst):
+    with open(src, 'rb') as fs:
+        with open(dst, 'wb') as fd:
+            try:
+                fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+            except OSError:
+                fd.close()
+                os.unlink(dst)
+                raise
+    shutil.copymode(src, dst)
+
+class Store:
+    # installed files are reflinked (or hardlinked) from one copy per content
+
+    def __init__(self, root):
+        self.root = root
+        self.can_reflink = fcntl is not None and hasattr(fcntl, 'ioctl')
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def add(self, src):
+        # returns the key of src, adopting src as the object if it's new
+        st = os.lstat(src)
+        if not stat.S_ISREG(st.st_mode) or st.st_size < min_size:
+            return
+        key = file_key(src, st)
+        obj = self.path(key)
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            try:
+                os.link(src, obj)
+            except FileExistsError:
+                pass
+            except OSError as e:
+                # other filesystem
+                log.debug('Can\'t store %s: %s', src, e)
+                return
+        return key
+
+    def place(self, key, dst):
+        obj = self.path(key)
+        tmp = dst + '.dpm-tmp'
+        if self.can_reflink:
+            try:
+                reflink(obj, tmp)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    raise
+                log.debug('No reflink support: %s', e)
+                self.can_reflink = False
+        if not self.can_reflink:
+            os.link(obj, tmp)
+            if os.path.lexists(dst) and os.path.samefile(tmp, dst):
+                # dst was adopted as the object itself, renaming a link over
+                # the same inode would leave tmp behind
+                os.unlink(tmp)
+                return
+        os.replace(tmp, dst)
+
+    def install_file(self, src, dst, keys):
+        for retry in range(2):
+            key = self.add(src)
+            if key is None:
+                os.replace(src, dst)
+                return
+            try:
+                self.place(key, dst)
+            except FileNotFoundError:
+                # object released meanwhile, add it again
+                continue
+            except OSError as e:
+                log.debug('Can\'t link %s: %s', dst, e)
+                os.replace(src, dst)
+                return
+            if src != dst:
+                os.unlink(src)
+            keys[dst] = key
+            return
+        os.replace(src, dst)
+
+    def adopt(self, path):
+        # links the files of path to the store in place, returns
+        # {path: key} of stored files
+        keys = {}
+        if not os.path.isdir(path) or os.path.islink(path):
+            self.install_file(path, path, keys)
+            return keys
+        for root, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                self.install_file(os.path.join(root, name),
+                    os.path.join(root, name), keys)
+        return keys
+
+    def release(self, keys):
+        # objects no installed file refers to
+        for key in db.unreferenced(keys):
+            log.debug('releasing %s', key)
+            try:
+                os.unlink(self.path(key))
+            except OSError:
+                pass
+
+    def gc(self):
+        if not os.path.isdir(self.root):
+            return 0, 0
+        now = time.time()
+        count = size = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            objects = {v.name: v for v in os.scandir(entry.path)}
+            for key in db.unreferenced(list(objects)):
+                st = objects[key].stat()
+                # leave objects of installs still in progress
+                if now - st.st_ctime < gc_grace:
+                    continue
+                log.debug('removing %s', key)
+                os.unlink(objects[key].path)
+                count += 1
+                size += st.st_size
+        return count, size
+
+def get_store():
+    # None unless "package_store" is enabled in dice.json
+    global _store
+    if not get_config().get('package_store', False):
+        return
+    root = os.path.join(get_packages_dirs()[-1], store_name)
+    with _store_lock:
+        if _store is None or _store.root != root:
+            _store = Store(root)
+        return _store
+
+def gc(args):
+    root = os.path.join(get_packages_dirs()[-1], store_name)
+    count, size = Store(root).gc()
+    log.info('Removed %i objects, %.1f MiB', count, size/2**20)
+
+parser = subparsers.add_parser('gc', help='remove unused files from the package store')
+parser.set_defaults(func=gc)
+parser.add_argument('-v', '--verbose', action='store_true', help="detailed output")
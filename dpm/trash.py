@@ -0,0 +1,156 @@
+import os
+import json
+import uuid
+import shutil
+import logging
+import threading
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from .config import get_packages_dirs
+from .utils import subparsers
+
+log = logging.getLogger('dpm')
+
+trash_name = '.dpm-trash'
+previous_name = '.dpm-previous'
+purge_jobs = 8
+
+_purge_proc = None
+_purge_lock = threading.Lock()
+
+def get_trash_dir(path):
+    # inside the packages dir, so moving there is a rename on one filesystem
+    return os.path.join(os.path.dirname(os.path.normpath(path)), trash_name)
+
+def get_previous_path(install_path):
+    # the release replaced by the last upgrade, kept for rollback
+    install_path = os.path.normpath(install_path)
+    return os.path.join(os.path.dirname(install_path), previous_name,
+        os.path.basename(install_path))
+
+def move_to_trash(path, files=(), trash_dir=None):
+    if trash_dir is None:
+        trash_dir = get_trash_dir(path)
+    entry = os.path.join(trash_dir, '%s-%s'%(os.path.basename(path),
+        uuid.uuid4().hex[:8]))
+    os.makedirs(entry)
+    tree = os.path.join(entry, 'tree')
+    try:
+        os.rename(path, tree)
+    except OSError:
+        os.rmdir(entry)
+        raise
+    manifest = []
+    for v in files:
+        rel = os.path.relpath(v, path)
+        if not rel.startswith(os.pardir):
+            manifest.append(rel)
+    with open(os.path.join(entry, 'files.json'), 'w') as f:
+        json.dump(manifest, f)
+    log.debug('moved %s to %s', path, entry)
+    return entry
+
+def discard_previous(install_path, files=()):
+    # files are recorded relative to the install path
+    previous_path = get_previous_path(install_path)
+    if not os.path.exists(previous_path):
+        return
+    files = [os.path.join(previous_path, os.path.relpath(v, install_path))
+        for v in files]
+    try:
+        move_to_trash(previous_path, files, get_trash_dir(install_path))
+    except OSError as e:
+        log.debug('Can\'t move %s to trash: %s', previous_path, e)
+        shutil.rmtree(previous_path)
+    else:
+        purge_trash_background()
+
+def swap_release(install_path, new_path):
+    # all renames stay inside the packages dir
+    previous_path = get_previous_path(install_path)
+    if not os.path.exists(install_path):
+        os.rename(new_path, install_path)
+        return
+    os.makedirs(os.path.dirname(previous_path), exist_ok=True)
+    os.rename(install_path, previous_path)
+    try:
+        os.rename(new_path, install_path)
+    except OSError:
+        os.rename(previous_path, install_path)
+        raise
+
+def unlink(path):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            return
+        os.unlink(path)
+    except OSError:
+        pass
+
+def purge_entry(entry, pool):
+    tree = os.path.join(entry, 'tree')
+    try:
+        with open(os.path.join(entry, 'files.json'), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = []
+    paths = [os.path.join(tree, v) for v in manifest]
+    list(pool.map(unlink, paths, chunksize=64))
+    # deepest folders first
+    for path in sorted(paths, key=lambda v: v.count(os.sep), reverse=True):
+        if os.path.isdir(path) and not os.path.islink(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+    # whatever the manifest missed
+    shutil.rmtree(entry, ignore_errors=True)
+
+def purge_trash():
+    with ThreadPoolExecutor(purge_jobs) as pool:
+        while True:
+            entries = []
+            for packages_dir in get_packages_dirs():
+                trash_dir = os.path.join(packages_dir, trash_name)
+                if os.path.isdir(trash_dir):
+                    entries += [v.path for v in os.scandir(trash_dir)]
+            if not entries:
+                break
+            for entry in entries:
+                log.debug('purging %s', entry)
+                purge_entry(entry, pool)
+                if os.path.exists(entry):
+                    log.warning('Can\'t delete %s', entry)
+                    return
+
+def has_trash():
+    for packages_dir in get_packages_dirs():
+        trash_dir = os.path.join(packages_dir, trash_name)
+        if os.path.isdir(trash_dir) and os.listdir(trash_dir):
+            return True
+    return False
+
+def purge_trash_background():
+    # detached "dpm purge" process, it outlives the current command
+    global _purge_proc
+    with _purge_lock:
+        if _purge_proc is not None and _purge_proc.poll() is None:
+            return
+        kwargs = {}
+        if os.name == 'nt':
+            kwargs['creationflags'] = (subprocess.DETACHED_PROCESS |
+                subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            kwargs['start_new_session'] = True
+        log.debug('starting trash purge')
+        _purge_proc = subprocess.Popen([sys.executable, '-m', 'dpm', 'purge'],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, **kwargs)
+
+def purge(args):
+    purge_trash()
+
+parser = subparsers.add_parser('purge', help='delete files of uninstalled packages')
+parser.set_defaults(func=purge)
+parser.add_argument('-v', '--verbose', action='store_true', help="detailed output")
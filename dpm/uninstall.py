@@ -3,18 +3,28 @@ import os
 import shutil
 import logging
 import sys
+from . import db
+from .config import update_location
+from .store import get_store
+from .profile import span, traced, annotate
+from .trash import (move_to_trash, has_trash, purge_trash_background,
+    discard_previous)
+from .graph import DependencyGraph
 
 class UninstallError(Exception):
     def __str__(self):
         return 'UninstallError: ' + Exception.__str__(self)
 
 def uninstall(args):
+    if has_trash():
+        purge_trash_background()
     try:
         packages = args.package
         del args.package
         for package in packages:
             log.info('Uninstalling %s'%package)
             uninstall_package(package, **vars(args))
+        report_orphans()
         log.info('Success')
     except UninstallError as e:
         log.error(str(e))
@@ -26,40 +36,81 @@ parser = subparsers.add_parser('uninstall', help='uninstall package(s)')
 parser.set_defaults(func=uninstall)
 parser.add_argument('package', nargs='+')
 parser.add_argument('-v', '--verbose', action='store_true', help="detailed output")
+parser.add_argument('-j', '--jobs', type=int, default=1, help="number of parallel hook commands")
 
-def uninstall_package(package, dice = None, other_deps = None, **kwargs):
-    install_path = get_install_path(package)
-    package_info = get_package_yaml(package, 'package.yaml')
+def autoremove(args):
+    # all packages installed as dependencies that nothing requires anymore,
+    # dependents first
+    if has_trash():
+        purge_trash_background()
+    graph = DependencyGraph.load()
+    orphans = graph.removal_order(graph.orphans())
+    if not orphans:
+        log.info('No packages to remove')
+        return
+    if not args.yes:
+        log.info('Packages no longer required:\n%s\n'
+            'Use --yes to uninstall them', '\n'.join(orphans))
+        return
+    try:
+        for package in orphans:
+            log.info('Uninstalling %s'%package)
+            uninstall_package(package, jobs=args.jobs)
+        log.info('Success')
+    except UninstallError as e:
+        log.error(str(e))
+        sys.exit(1)
+
+parser = subparsers.add_parser('autoremove', help='uninstall packages installed as dependencies and no longer required')
+parser.set_defaults(func=autoremove)
+parser.add_argument('-y', '--yes', action='store_true', help="uninstall them, otherwise they are only listed")
+parser.add_argument('-v', '--verbose', action='store_true', help="detailed output")
+parser.add_argument('-j', '--jobs', type=int, default=1, help="number of parallel hook commands")
 
-    if package_info == None:
+@traced('uninstall_package')
+def uninstall_package(package, dice = None, jobs = 1, **kwargs):
+    annotate(package=package)
+    installed = db.get_package(package)
+
+    if installed == None:
         raise UninstallError('Package %s not installed'%package)
 
-    install_info = get_package_yaml(package, 'install.yaml')
+    install_path = installed['install_path']
+    install_info = installed['install_info']
 
-    for v in install_info.get('pre_uninstall', ()):
-        if not run_process(command=v, cwd=install_path):
+    with span('pre_uninstall'):
+        if not run_commands(install_info.get('pre_uninstall', ()),
+                cwd=install_path, jobs=jobs):
             raise UninstallError('Pre-uninstall command error.')
 
     try:
         log.debug('deleting: %s', install_path) 
-        shutil.rmtree(install_path)
+        try:
+            with span('trash'):
+                move_to_trash(install_path, db.get_files(package))
+        except OSError as e:
+            log.debug('Can\'t move %s to trash: %s', install_path, e)
+            with span('rmtree'):
+                shutil.rmtree(install_path)
+        else:
+            purge_trash_background()
+        update_location(package)
+        previous = db.get_previous(package)
+        discard_previous(install_path, previous['files'] if previous else ())
     except Exception as e:
         log.warn('Can\'t delete %s:\n%s', install_path, str(e))
         log.warn('Not all resources was deleted, verify log above.')
 
-    deps = install_info.get('dependencies')
-    if deps:
-        if other_deps:
-            other_deps = [info_from_name(v)[0] for v in other_deps]
-        for v in deps:
-            name = info_from_name(v)[0]
-            deps_list = get_package_list(name, 'deps.txt')
-            if package_info['name'] in deps_list:
-                deps_list.remove(package_info['name'])
-                save_package_list(name, 'deps.txt', deps_list)
-                if (not deps_list and
-                        (not other_deps or name not in other_deps)):
-                    if input('Package "%s" no longer required\n'
-                            'Uninstall? [y/N]:'%dep_info['name']
-                            ).lower().startswith('y'):
-                        uninstall_package(name)
+    hashes = db.get_hashes(package)
+    with span('db'):
+        db.remove_package(package)
+    store = get_store()
+    if store:
+        store.release(hashes)
+
+def report_orphans():
+    orphans = DependencyGraph.load().orphans()
+    if orphans:
+        log.info('Packages no longer required: %s\n'
+            'Use "dpm autoremove --yes" to uninstall them',
+            ', '.join(sorted(orphans)))
@@ -2,26 +2,27 @@
 import os
 import sys
 import re
-import yaml
 import argparse
 import logging
 import subprocess
 import platform
 import time
 import io
-import json
 import shlex
 import signal
-import builtins
-import requests
-import progressbar
-import rfc6266
 import locale
 import codecs
-from datetime import datetime
+import hashlib
+import threading
+import selectors
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .cache import DownloadCache
+from .profile import traced, annotate, count
+from .config import get_config, get_packages_dirs, get_install_path
 
 __all__ = [
     'run_process',
+    'run_commands',
     'log',
     'parser',
     'subparsers',
@@ -30,30 +31,185 @@ __all__ = [
     'system_name',
     'info_from_name',
     'get_install_path',
-    'get_package_yaml',
-    'get_package_list',
-    'save_package_list',
+    'get_packages_dirs',
     'find_python',
     'system',
-    'download'
+    'get_config',
+    'download',
+    'download_many',
+    'is_url',
+    'load_yaml'
     ]
 
 log = logging.getLogger('dpm')
 
 parser = argparse.ArgumentParser(prog='dpm')
+parser.add_argument('--profile', action='store_true',
+    help="print time, bytes and files per phase of the command")
+parser.add_argument('--trace', metavar='TRACE',
+    help="write phases of the command to TRACE in Chrome trace format")
+parser.add_argument('--cprofile', metavar='STATS',
+    help="dump cProfile stats of the main thread to STATS")
 subparsers = parser.add_subparsers(help='command', metavar='command')
 subparsers.required = True
     
 from threading import Thread
 from queue import Queue, Empty
-import ctypes
+
+class CommandError(Exception):
+    def __str__(self):
+        return 'CommandError: ' + Exception.__str__(self)
 
 class DownloadError(Exception):
     def __str__(self):
         return 'DownloadError: ' + Exception.__str__(self)
 
-def download(target_dir, url):
-    response = requests.get(url, stream=True)
+cache_dir = os.path.join(os.path.expanduser("~"), ".DICE", "cache", "downloads")
+default_cache_size = 4096 # MiB
+
+default_chunk_size = 1024 # KiB
+default_pool_size = 16
+
+_download_cache = None
+_download_cache_lock = threading.Lock()
+_session = None
+
+def get_download_cache():
+    global _download_cache
+    with _download_cache_lock:
+        if _download_cache is None:
+            cfg = get_config()
+            if not cfg.get('download_cache', True):
+                _download_cache = False
+            else:
+                size = cfg.get('download_cache_size', default_cache_size)
+                _download_cache = DownloadCache(
+                    cfg.get('download_cache_dir', cache_dir), size * 2**20)
+        return _download_cache
+
+def get_session():
+    # requests is only imported by commands that download
+    import requests
+    import requests.adapters
+    global _session
+    with _download_cache_lock:
+        if _session is None:
+            size = get_config().get('download_pool_size', default_pool_size)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=size, pool_maxsize=size)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+class Progress:
+
+    def __init__(self, total=None, interval=0.25):
+        import progressbar
+        if total:
+            widgets = [progressbar.Percentage(), ' ', progressbar.Bar(),
+                ' ', progressbar.ETA(), ' ', progressbar.FileTransferSpeed()]
+        else:
+            total = progressbar.UnknownLength
+            widgets = [progressbar.AnimatedMarker(), ' ', progressbar.DataSize(),
+                ' ', progressbar.FileTransferSpeed()]
+        self.pbar = progressbar.ProgressBar(widgets=widgets, max_value=total)
+        self.interval = interval
+        self.value = 0
+        self.last = 0
+        self.lock = threading.Lock()
+        self.pbar.start()
+
+    def update(self, size):
+        with self.lock:
+            self.value += size
+            now = time.monotonic()
+            if now - self.last >= self.interval:
+                self.last = now
+                self.pbar.update(self.value)
+
+    def finish(self):
+        with self.lock:
+            self.pbar.update(self.value)
+            self.pbar.finish()
+
+def download_many(target_dir, urls, jobs=4, chunk_size=None, checksums=None):
+    # checksums: expected sha256 of each url, or None
+    checksums = checksums or [None] * len(urls)
+    if len(urls) < 2:
+        return [download(target_dir, v, chunk_size=chunk_size, checksum=c)
+            for v, c in zip(urls, checksums)]
+    progress = Progress()
+    try:
+        with ThreadPoolExecutor(max(jobs, 1)) as pool:
+            futures = [pool.submit(download, target_dir, v,
+                progress=progress, chunk_size=chunk_size, checksum=c)
+                for v, c in zip(urls, checksums)]
+            return [v.result() for v in futures]
+    finally:
+        progress.finish()
+
+@traced('download')
+def download(target_dir, url, progress=None, chunk_size=None, checksum=None,
+        sink=None):
+    # checksum: expected sha256, verified while streaming;
+    # sink: called with the package data block by block from its start, not
+    # called at all when a cached copy is used
+    annotate(url=url)
+    cache = get_download_cache()
+    if cache is None:
+        return _download(target_dir, url, progress, chunk_size, checksum,
+            sink, cache)
+    # another process downloading the same url is waited for, its copy is
+    # then found in the cache
+    with cache.claim(url):
+        return _download(target_dir, url, progress, chunk_size, checksum,
+            sink, cache)
+
+def _download(target_dir, url, progress, chunk_size, checksum, sink, cache):
+    import requests
+    import rfc6266
+    if chunk_size is None:
+        chunk_size = get_config().get('download_chunk_size',
+            default_chunk_size) * 1024
+    entry = cache.lookup(url) if cache else None
+    if entry and checksum:
+        # the content is pinned, no need to ask the server
+        if entry['sha256'] == checksum:
+            log.info('Using cached %s'%os.path.basename(entry['path']))
+            return entry['path']
+        entry = None
+    headers = {}
+    if entry:
+        if 'etag' in entry:
+            headers['If-None-Match'] = entry['etag']
+        elif 'last_modified' in entry:
+            headers['If-Modified-Since'] = entry['last_modified']
+        else:
+            log.info('Using cached %s'%os.path.basename(entry['path']))
+            return entry['path']
+
+    offset = 0
+    if cache and not entry:
+        partial, offset, validators = cache.partial(url)
+        validator = validators.get('etag') or validators.get('last_modified')
+        if offset and validator:
+            headers['Range'] = 'bytes=%i-'%offset
+            headers['If-Range'] = validator
+        else:
+            offset = 0
+
+    try:
+        response = get_session().get(url, headers=headers, stream=True)
+    except requests.ConnectionError:
+        if entry:
+            log.warning('Can\'t reach %s, using cached package', url)
+            return entry['path']
+        raise
+
+    if entry and response.status_code == 304:
+        log.info('Using cached %s'%os.path.basename(entry['path']))
+        return entry['path']
 
     if not response.ok:
         raise DownloadError('Can\'t download %s: response status: %i'%\
@@ -66,25 +222,167 @@ def download(target_dir, url):
     if not fname:
         fname = os.path.basename(url)
 
-    log.info('Downloading %s'%fname)
+    if response.status_code != 206:
+        offset = 0
 
-    total = response.headers.get('content-length').strip()
+    log.info('%s %s'%('Resuming' if offset else 'Downloading', fname))
+
+    total = response.headers.get('content-length', '').strip()
     if total:
-        total = int(total)
-    path = os.path.join(target_dir, fname)
-
-    with open(path, 'wb') as f:
-        widgets = [progressbar.Percentage(), ' ', progressbar.Bar(),
-                   ' ', progressbar.ETA(), ' ', progressbar.FileTransferSpeed()]
-        pbar = progressbar.ProgressBar(widgets=widgets, max_value=total).start()
-        size = 0
-        for block in response.iter_content(1024):
-            size += len(block)
-            f.write(block)
-            pbar.update(size)
-        pbar.finish()
+        total = int(total) + offset
+
+    validators = {}
+    if 'ETag' in response.headers:
+        validators['etag'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        validators['last_modified'] = response.headers['Last-Modified']
+
+    sha256 = hashlib.sha256()
+    if cache:
+        path = cache.begin(url, validators)
+        if offset:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    sha256.update(block)
+                    if sink:
+                        sink(block)
+    else:
+        path = os.path.join(target_dir, fname)
+
+    with open(path, 'ab' if offset else 'wb') as f:
+        if progress is None:
+            pbar = Progress(total)
+            pbar.update(offset)
+        else:
+            pbar = progress
+        try:
+            for block in response.iter_content(chunk_size):
+                sha256.update(block)
+                f.write(block)
+                if sink:
+                    sink(block)
+                pbar.update(len(block))
+                count(bytes=len(block))
+        finally:
+            response.close()
+            if progress is None:
+                pbar.finish()
+
+    if checksum and sha256.hexdigest() != checksum:
+        os.remove(path)
+        if cache and os.path.exists(path + '.json'):
+            os.remove(path + '.json')
+        raise DownloadError('Checksum mismatch for %s: expected %s, got %s'%
+            (url, checksum, sha256.hexdigest()))
+
+    if cache:
+        return cache.commit(url, path, fname, sha256.hexdigest(), validators)
     return path
 
+read_chunk_size = 2**16
+newline = re.compile(r'\r\n|\r|\n')
+
+class OutputReader:
+    # incremental decoding and line splitting of a process stream
+
+    def __init__(self, out, encoding):
+        self.out = out
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='ignore')
+        self.pending = ''
+
+    def feed(self, data):
+        count(bytes=len(data))
+        if isinstance(self.out, io.BytesIO):
+            self.out.write(data)
+            return
+        text = self.decoder.decode(data)
+        if isinstance(self.out, io.StringIO):
+            self.out.write(text)
+            return
+        text = self.pending + text
+        # '\r' at the end may be the first half of '\r\n'
+        tail = ''
+        if text.endswith('\r'):
+            text, tail = text[:-1], '\r'
+        lines = newline.split(text)
+        self.pending = lines.pop() + tail
+        for line in lines:
+            self.out(line)
+
+    def close(self):
+        if isinstance(self.out, io.BytesIO):
+            return
+        text = self.decoder.decode(b'', final=True)
+        if isinstance(self.out, io.StringIO):
+            self.out.write(text)
+            return
+        text = (self.pending + text).rstrip('\r')
+        self.pending = ''
+        for line in newline.split(text) if text else ():
+            self.out(line)
+
+class SelectPump:
+
+    def __init__(self, readers):
+        self.sel = selectors.DefaultSelector()
+        for stream, reader in readers:
+            self.sel.register(stream, selectors.EVENT_READ, reader)
+
+    def done(self):
+        return not self.sel.get_map()
+
+    def step(self, timeout):
+        for key, events in self.sel.select(timeout):
+            data = os.read(key.fd, read_chunk_size)
+            if data:
+                key.data.feed(data)
+            else:
+                self.sel.unregister(key.fileobj)
+                key.data.close()
+
+    def close(self):
+        self.sel.close()
+
+class ThreadPump:
+    # pipes can't be selected on Windows
+
+    def __init__(self, readers):
+        self.q = Queue()
+        self.left = len(readers)
+        for stream, reader in readers:
+            Thread(target=self.pump, daemon=True, args=(stream, reader)).start()
+
+    def pump(self, stream, reader):
+        try:
+            for data in iter(lambda: stream.read1(read_chunk_size), b''):
+                self.q.put((reader.feed, data))
+        finally:
+            self.q.put((None, reader))
+
+    def done(self):
+        return not self.left
+
+    def step(self, timeout):
+        try:
+            item = self.q.get(timeout=timeout)
+        except Empty:
+            return
+        while item:
+            func, data = item
+            if func is None:
+                data.close()
+                self.left -= 1
+            else:
+                func(data)
+            try:
+                item = self.q.get_nowait()
+            except Empty:
+                item = None
+
+    def close(self):
+        pass
+
+@traced('run_process')
 def run_process(*args, command=None, stop=None, stdout=log.debug,
         stderr=log.error, cwd=None, format_kwargs=None,
         yield_func=None, **kwargs):
@@ -109,80 +407,40 @@ def run_process(*args, command=None, stop=None, stdout=log.debug,
         args = [v.format(**format_kwargs) for v in args]
 
     log.debug('running: %s'%' '.join([shlex.quote(v) for v in args]))
+    annotate(command=command_label(' '.join(args)))
 
-    current_dir = os.getcwd()
-    os.chdir(cwd)
-    try:
-        proc = subprocess.Popen(args, stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE, **kwargs)
-    finally:
-        os.chdir(current_dir)
-
-    def wait():
-        proc.wait()
-        q.put(lambda: None)
-
-    def read(stream, out):
-        if isinstance(stream, io.TextIOWrapper):
-            if callable(out):
-                result = ''
-                for char in iter(lambda: stream.read(1), ''):
-                    if char in ('\n', '\r'):
-                        if result:
-                            q.put(lambda o=result: out(o))
-                            result = ''
-                    else:
-                        result += char
-                if result:
-                    q.put(lambda o=result[:-1]: out(o))
-            elif isinstance(out, io.StringIO):
-                for data in iter(stream.read, b''):
-                    out.write(data)
-            elif isinstance(out, io.BytesIO):
-                for data in iter(stream.read, b''):
-                    out.write(data.encode('utf8'))     
-        else:
-            if callable(out):
-                encoding = locale.getpreferredencoding(False)
-                result = ''
-                it = iter(lambda: stream.read(1), b'')
-                for char in codecs.iterdecode(it, encoding, errors='ignore'):
-                    if char in ('\n', '\r'):
-                        q.put(lambda o=result: out(o))
-                        result = ''
-                    else:
-                        result += char
-                if result:
-                    q.put(lambda o=result[:-1]: out(o))
-            elif isinstance(out, io.StringIO):
-                encoding = locale.getpreferredencoding(False)
-                it = iter(stream.read, b'')
-                for data in codecs.iterdecode(it, encoding, errors='ignore'):
-                    out.write(data)
-            elif isinstance(out, io.BytesIO):
-                for data in iter(stream.read, b''):
-                    out.write(data)
-
-    q = Queue()        
-    running = True
-    exc = None
+    encoding = kwargs.pop('encoding', None) or locale.getpreferredencoding(False)
+    for v in ('universal_newlines', 'text', 'errors'):
+        kwargs.pop(v, None)
 
-    threads = [ Thread(target = wait, daemon=True) ]
+    proc = subprocess.Popen(args,
+        stdout = subprocess.DEVNULL if stdout is None else subprocess.PIPE,
+        stderr = subprocess.DEVNULL if stderr is None else subprocess.PIPE,
+        cwd = cwd, **kwargs)
 
+    readers = []
     if stdout is not None:
-        th = Thread(target = read, daemon=True, args=(proc.stdout, stdout))      
-        threads.append(th)
-
+        readers.append((proc.stdout, OutputReader(stdout, encoding)))
     if stderr is not None:
-        th = Thread(target = read, daemon=True, args=(proc.stderr, stderr))      
-        threads.append(th)
+        readers.append((proc.stderr, OutputReader(stderr, encoding)))
+
+    # wake up only to check stop/yield_func and to let ctrl+c through on Windows
+    if stop is None and yield_func is None and system != 'Windows':
+        timeout = None
+    else:
+        timeout = 0.1
+
+    if system == 'Windows':
+        pump = ThreadPump(readers)
+    else:
+        pump = SelectPump(readers)
 
-    for v in threads:
-        v.start()
+    running = True
+    exc = None
 
     while True:
         try:
-            while True:
+            while not pump.done():
                 if yield_func is not None:
                     yield_func()
                 if running and stop is not None and stop():
@@ -192,12 +450,8 @@ def run_process(*args, command=None, stop=None, stdout=log.debug,
                     except:
                         pass
                     running = False
-                alive = any((v.is_alive() for v in threads))
-                try:
-                    q.get(alive, timeout=0.1)()
-                except Empty:
-                    if not alive:
-                        break
+                pump.step(timeout)
+            proc.wait()
             break
         except KeyboardInterrupt as e:
             if running:
@@ -209,12 +463,118 @@ def run_process(*args, command=None, stop=None, stdout=log.debug,
                 running = False
                 exc = e
 
+    pump.close()
+    for stream, reader in readers:
+        stream.close()
+
     if exc:
         raise exc
     else:
         log.debug('return code: %i'%proc.returncode)
         return proc.returncode == 0
 
+def command_label(command):
+    if isinstance(command, dict):
+        if 'name' in command:
+            return str(command['name'])
+        command = ' '.join(command.get('args', ()))
+    command = str(command)
+    return command if len(command) <= 40 else command[:37] + '...'
+
+def command_graph(commands):
+    # list items run in order; {parallel: [...]} runs its members together,
+    # {name: ..., after: [...]} waits only for the named commands
+    nodes = []
+    names = {}
+    for item in commands:
+        before = list(range(len(nodes)))
+        if isinstance(item, dict) and 'parallel' in item:
+            group = item['parallel']
+            if not isinstance(group, list):
+                group = [group]
+        else:
+            group = [item]
+        for command in group:
+            if isinstance(command, dict) and 'parallel' in command:
+                raise CommandError('Nested parallel groups are not supported')
+            after = before
+            if isinstance(command, dict):
+                if 'name' in command:
+                    names[command['name']] = len(nodes)
+                if 'after' in command:
+                    after = command['after']
+                    if not isinstance(after, list):
+                        after = [after]
+            nodes.append(dict(command=command, after=after,
+                label=command_label(command)))
+    for node in nodes:
+        deps = set()
+        for v in node['after']:
+            if isinstance(v, int):
+                deps.add(v)
+            elif v in names:
+                deps.add(names[v])
+            else:
+                raise CommandError('Unknown command "%s" in "after" of "%s"'%
+                    (v, node['label']))
+        node['after'] = deps
+    return nodes
+
+def run_commands(commands, cwd=None, format_kwargs=None, jobs=1):
+    try:
+        nodes = command_graph(commands)
+    except CommandError as e:
+        log.error(e)
+        return False
+
+    if jobs <= 1 or len(nodes) <= 1:
+        done = set()
+        while len(done) < len(nodes):
+            ready = [i for i, v in enumerate(nodes)
+                if i not in done and v['after'] <= done]
+            if not ready:
+                log.error('Circular "after" dependencies in commands')
+                return False
+            if not run_process(command=nodes[ready[0]]['command'], cwd=cwd,
+                    format_kwargs=format_kwargs):
+                return False
+            done.add(ready[0])
+        return True
+
+    failed = threading.Event()
+
+    def run(node):
+        label = node['label']
+        return run_process(command=node['command'], cwd=cwd,
+            format_kwargs=format_kwargs, stop=failed.is_set,
+            stdout=lambda line: log.debug('[%s] %s', label, line),
+            stderr=lambda line: log.error('[%s] %s', label, line))
+
+    done = set()
+    running = {}
+    with ThreadPoolExecutor(jobs) as pool:
+        try:
+            while len(done) < len(nodes) and not failed.is_set():
+                for i, node in enumerate(nodes):
+                    if (i not in done and i not in running.values() and
+                            node['after'] <= done):
+                        running[pool.submit(run, node)] = i
+                if not running:
+                    log.error('Circular "after" dependencies in commands')
+                    failed.set()
+                    break
+                for future in wait(running, return_when=FIRST_COMPLETED)[0]:
+                    i = running.pop(future)
+                    if future.result():
+                        done.add(i)
+                    else:
+                        log.error('[%s] failed', nodes[i]['label'])
+                        failed.set()
+        except:
+            failed.set()
+            raise
+    return not failed.is_set()
+
 is_64bits = sys.maxsize > 2**32
 system = platform.system()
 
@@ -253,44 +613,20 @@ def find_python(python_path, base_path=''):
     else:
         return os.path.normpath(python_path)
 
-packages_install_dir  = os.path.join(os.path.expanduser("~"), ".DICE", "data", "packages")
-dice_config = os.path.join(os.path.expanduser("~"), ".DICE", "config", "dice.json")
-
-def get_install_path(package_name):
-    package_name = package_name.replace('/', '-')
-    default_dir = packages_install_dir
-    paths = []
-    if os.path.exists(dice_config):
-        with open(dice_config) as f:
-            cfg = json.load(f)
-            paths += cfg.get('packages_dirs', [])
-            if 'packages_install_dir' in cfg:
-                default_dir = cfg['packages_install_dir']
-    paths.append(default_dir)
-    for v in set(paths):
-        package_dir = os.path.join(v, package_name)
-        if os.path.exists(package_dir):
-            return package_dir
-    return os.path.join(default_dir, package_name)
-
-def get_package_yaml(package_name, file_name):
-    package_yaml = os.path.join(get_install_path(package_name), file_name)
-    if os.path.exists(package_yaml):
-        with open(package_yaml, 'r') as f:
-            return yaml.load(f)
-
-def get_package_list(package_name, file_name):
-    path = os.path.join(get_install_path(package_name), file_name)
-    if os.path.exists(path):
-        with open(path, 'r') as f:
-            return f.read().split('\n')
-    return []
-
-def save_package_list(package_name, file_name, items):
-    install_path = get_install_path(package_name)
-    path = os.path.join(install_path, file_name)
-    with open(path, 'w') as f:
-        f.write('\n'.join(items))
+def is_url(package):
+    if os.path.exists(package):
+        return False
+    import rfc3987
+    try:
+        rfc3987.parse(package, rule='IRI')
+    except ValueError:
+        return False
+    return True
+
+def load_yaml(stream):
+    # the libyaml loader when PyYAML is built with it
+    import yaml
+    return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 def info_from_name(package):
     values = package.split('==')
@@ -0,0 +1,55 @@
+import io
+import os
+import random
+import pytest
+from dpm.delta import DeltaError, block_size, diff, patch
+
+def round_trip(tmp_path, old, new, max_literal=None):
+    old_path = str(tmp_path / 'old')
+    with open(old_path, 'wb') as f:
+        f.write(old)
+    diff_f = io.BytesIO()
+    assert diff(old, new, diff_f, max_literal)
+    diff_f.seek(0)
+    out_f = io.BytesIO()
+    patch(old_path, diff_f, out_f, chunk_size=1000)
+    assert out_f.getvalue() == new
+    return diff_f.getvalue()
+
+def test_identical(tmp_path):
+    data = os.urandom(10 * block_size)
+    assert len(round_trip(tmp_path, data, data)) < 100
+
+def test_empty(tmp_path):
+    round_trip(tmp_path, b'', b'')
+    round_trip(tmp_path, b'', b'new')
+    round_trip(tmp_path, b'old', b'')
+
+def test_edits(tmp_path):
+    rnd = random.Random(0)
+    old = bytes(rnd.getrandbits(8) for _ in range(40 * block_size))
+    # unaligned insertions, a deletion and a replaced run
+    new = (b'head' + old[:5000] + b'inserted' + old[5000:60000] +
+        old[70000:100000] + os.urandom(3000) + old[103000:] + b'tail')
+    delta = round_trip(tmp_path, old, new)
+    assert len(delta) < 4 * block_size
+
+def test_max_literal(tmp_path):
+    old = os.urandom(64 * block_size)
+    new = os.urandom(64 * block_size)
+    assert not diff(old, new, io.BytesIO(), len(new) // 2)
+    # half of new is copied, half is literal
+    new = old[:32 * block_size] + new[32 * block_size:]
+    assert not diff(old, new, io.BytesIO(), len(new) // 4)
+    round_trip(tmp_path, old, new, len(new) * 0.8)
+
+def test_bad_diff(tmp_path):
+    old_path = str(tmp_path / 'old')
+    with open(old_path, 'wb') as f:
+        f.write(b'old')
+    with pytest.raises(DeltaError):
+        patch(old_path, io.BytesIO(b'garbage'), io.BytesIO())
+    diff_f = io.BytesIO()
+    diff(b'old', b'new data', diff_f)
+    with pytest.raises(DeltaError):
+        patch(old_path, io.BytesIO(diff_f.getvalue()[:-2]), io.BytesIO())
@@ -0,0 +1,13 @@
+import os
+import sys
+import subprocess
+
+bench = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks', 'bench_startup.py')
+
+def test_startup_budget():
+    # the benchmark exits with 1 when a command's median is over its budget
+    result = subprocess.run([sys.executable, bench, '--repeat', '5'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+    assert result.returncode == 0, result.stdout